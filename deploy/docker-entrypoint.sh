@@ -1,7 +1,14 @@
 #!/bin/sh
 
 poetry run python manage.py migrate
-poetry run python manage.py createcachetable
+poetry run python manage.py createcachetable --database cache
 poetry run python manage.py collectstatic --no-input
 poetry run python manage.py check --deploy
-poetry run gunicorn -b 0.0.0.0:8000 project.wsgi
+
+# UNCLEBUDGET_SERVER=asgi serves the async pages from an event loop, so one
+# worker can handle many concurrent page loads
+if [ "$UNCLEBUDGET_SERVER" = "asgi" ]; then
+    poetry run gunicorn -b 0.0.0.0:8000 -k uvicorn_worker.UvicornWorker project.asgi
+else
+    poetry run gunicorn -b 0.0.0.0:8000 project.wsgi
+fi
@@ -36,11 +36,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "unclebudget.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "unclebudget.middleware.UserDataMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -71,29 +73,111 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "project.wsgi.application"
 
-DATABASES = {
-    "default": {
+# SQLite tuning, run on each new connection. Each pragma can be changed with
+# UNCLEBUDGET_SQLITE_<NAME> (UNCLEBUDGET_CACHE_SQLITE_<NAME> for the cache
+# database), or left at SQLite's default by setting it empty. WAL lets pages
+# read while an import is writing, and busy_timeout (in ms) makes a writer
+# wait for the lock instead of failing.
+SQLITE_PRAGMA_DEFAULTS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    # Negative sizes are in KiB
+    "cache_size": "-32000",
+    "mmap_size": str(256 * 1024 * 1024),
+    "temp_store": "memory",
+    "busy_timeout": "5000",
+}
+
+
+def sqlite_pragmas(prefix, **defaults):
+    return {
+        name: environ.get(f"{prefix}{name.upper()}", default)
+        for name, default in {**SQLITE_PRAGMA_DEFAULTS, **defaults}.items()
+    }
+
+
+# Reuse connections across requests instead of reopening the file and
+# rerunning the pragmas for each one. Not under ASGI, where connections belong
+# to threads that come and go, so persistent ones aren't reliably closed.
+DB_CONN_MAX_AGE = int(
+    environ.get(
+        "UNCLEBUDGET_DB_CONN_MAX_AGE",
+        0 if environ.get("UNCLEBUDGET_SERVER") == "asgi" else 600,
+    )
+)
+
+
+def sqlite_database(name, pragmas):
+    return {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": environ.get("UNCLEBUDGET_DB_FILE", BASE_DIR / "db.sqlite3"),
+        "NAME": name,
+        "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "init_command": ";".join(
+                f"PRAGMA {name} = {value}" for name, value in pragmas.items() if value
+            ),
+            # Take the write lock when a transaction starts, where busy_timeout
+            # can wait for it. A transaction that reads and then writes can't
+            # wait, and fails if another connection wrote in between.
+            "transaction_mode": "IMMEDIATE",
+        },
     }
+
+
+SQLITE_PRAGMAS = sqlite_pragmas("UNCLEBUDGET_SQLITE_")
+# The cache is small, so it needs less memory
+CACHE_SQLITE_PRAGMAS = sqlite_pragmas(
+    "UNCLEBUDGET_CACHE_SQLITE_", cache_size="-8000", mmap_size=str(64 * 1024 * 1024)
+)
+
+# The database cache gets its own file, so cache writes don't wait on (or
+# hold up) ledger writes for the sqlite write lock
+DATABASES = {
+    "default": sqlite_database(
+        environ.get("UNCLEBUDGET_DB_FILE", BASE_DIR / "db.sqlite3"), SQLITE_PRAGMAS
+    ),
+    "cache": sqlite_database(
+        environ.get("UNCLEBUDGET_CACHE_DB_FILE", BASE_DIR / "cache.sqlite3"),
+        CACHE_SQLITE_PRAGMAS,
+    ),
 }
 
+DATABASE_ROUTERS = ["unclebudget.routers.CacheRouter"]
+
 USE_TZ = True
 TIME_ZONE = environ.get("UNCLEBUDGET_TIMEZONE", "America/Chicago")
 
 STATIC_URL = "static/"
 STATIC_ROOT = environ.get("UNCLEBUDGET_STATIC_ROOT", BASE_DIR / "www/")
 
+# Uploaded CSVs wait here until they're loaded
+MEDIA_ROOT = environ.get("UNCLEBUDGET_MEDIA_ROOT", BASE_DIR / "media/")
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# unclebudget.cache keeps values in an in-process LRU in front of the
+# database cache. Invalidating a value only clears it from the LRU of the
+# process that made the change, so with several worker processes the others
+# can serve the old value (a balance, say) for up to
+# UNCLEBUDGET_CACHE_LOCAL_TIMEOUT seconds. Set it to 0 to turn the LRU off
+# when that matters more than the saved queries.
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "BACKEND": "unclebudget.cache_backends.LayeredCache",
+        "LOCATION": "shared",
+        "OPTIONS": {
+            "MAX_ENTRIES": 1000,
+            "LOCAL_TIMEOUT": int(environ.get("UNCLEBUDGET_CACHE_LOCAL_TIMEOUT", 5)),
+        },
+    },
+    "shared": {
+        "BACKEND": "unclebudget.cache_backends.DatabaseCache",
         "LOCATION": "cache",
         "OPTIONS": {
             "MAX_ENTRIES": 2000,
         },
-    }
+    },
 }
 
 LOGIN_URL = "/login"
@@ -104,5 +188,22 @@ UNCLEBUDGET_LOADERS = [
     "loaders.second",
 ]
 
+# Bearer token for scraping /metrics; staff users can always see it
+UNCLEBUDGET_METRICS_TOKEN = environ.get("UNCLEBUDGET_METRICS_TOKEN", None)
+
+# Where uploaded CSVs are loaded: "thread" for a background thread in the
+# web process, "worker" to leave them for `manage.py runimports`, or
+# "inline" to load them during the upload request
+UNCLEBUDGET_IMPORT_MODE = environ.get("UNCLEBUDGET_IMPORT_MODE", "thread")
+
+# Seconds a running import can go without committing a chunk before it's
+# assumed its process stopped, and it's queued again
+UNCLEBUDGET_IMPORT_STALE_SECONDS = int(
+    environ.get("UNCLEBUDGET_IMPORT_STALE_SECONDS", 300)
+)
+
+# Number of months shown by default in the expenses by month report
+UNCLEBUDGET_REPORT_MONTHS = int(environ.get("UNCLEBUDGET_REPORT_MONTHS", 14))
+
 # Single user mode: automatically log in as the user with the specified ID
 UNCLEBUDGET_SINGLE_USER = environ.get("UNCLEBUDGET_SINGLE_USER", None)
@@ -5,6 +5,7 @@ from .models import *
 admin.site.register(Account)
 admin.site.register(Entry)
 admin.site.register(Envelope)
+admin.site.register(ImportJob)
 admin.site.register(Item)
 admin.site.register(Load)
 admin.site.register(Note)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class UnclebudgetConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "unclebudget"
+
+    def ready(self):
+        from .loader import register_loaders
+
+        register_loaders()
@@ -0,0 +1,189 @@
+"""Timings of the views and the cache, stats and loader entry points"""
+
+from statistics import mean, median
+from threading import Thread
+from time import perf_counter
+
+from django.core.cache import caches
+from django.db import OperationalError, connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import cache, stats, synthetic
+from .loader import load_entries
+from .models import *
+
+# Rows in the CSV given to load_entries
+LOAD_ROWS = 1000
+
+# Rows in the CSV imported while reads are timed
+IMPORT_ROWS = 20000
+
+
+def targets(user):
+    """(name, function) pairs to time for user, who needs a synthetic ledger"""
+    client = Client()
+    client.force_login(user)
+
+    account = Account.objects.filter(user=user).first()
+    accounts = list(Account.objects.filter(user=user))
+    envelope = Envelope.objects.filter(user=user).exclude(name="Income").first()
+    envelopes = list(Envelope.objects.filter(user=user))
+    entry = Entry.objects.unbalanced_for(user).first()
+    last_item = envelope.item_set.first()
+    csv = synthetic.csv(LOAD_ROWS)
+
+    def view(name, *args):
+        url = reverse(name, args=args)
+
+        def get():
+            response = client.get(url)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+
+        return f"view:{name}", get
+
+    def rolled_back(function):
+        def run():
+            with transaction.atomic():
+                function()
+                transaction.set_rollback(True)
+
+        return run
+
+    return [
+        view("summary"),
+        view("all"),
+        view("process"),
+        view("account-detail", account.pk),
+        view("envelope-detail", envelope.pk),
+        view("envelope_month", envelope.pk, last_item.date.year, last_item.date.month),
+        view("entry-detail", entry.pk),
+        view("envelope-transfer"),
+        view("expect"),
+        view("upload"),
+        view("report-expenses-by-month"),
+        view("report-income"),
+        ("cache:get_account_balances", lambda: cache.get_account_balances(accounts)),
+        (
+            "cache:get_envelope_balances",
+            lambda: cache.get_envelope_balances(envelopes),
+        ),
+        ("cache:get_skipped_entries", lambda: cache.get_skipped_entries(user)),
+        ("cache:get_user_data", lambda: cache.get_user_data(user)),
+        ("stats:stats", lambda: stats.stats(user)),
+        (
+            "stats:envelope_monthly_expenses",
+            lambda: stats.envelope_monthly_expenses(user),
+        ),
+        ("loader:load_entries", rolled_back(lambda: load_entries(account, csv))),
+    ]
+
+
+def run(user, repeat=5):
+    """Time each target, with a cold cache each time
+
+    Returns a dict for each target with its name, the number of queries it
+    made, and the minimum, median and mean of its times in seconds.
+    """
+    results = []
+    for name, function in targets(user):
+        # The first call warms up templates and imports, and counts queries
+        caches["default"].clear()
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        query_count = len(queries)
+
+        times = []
+        for _ in range(repeat):
+            caches["default"].clear()
+            start = perf_counter()
+            function()
+            times.append(perf_counter() - start)
+
+        results.append(
+            {
+                "name": name,
+                "queries": query_count,
+                "min": min(times),
+                "median": median(times),
+                "mean": mean(times),
+            }
+        )
+    return results
+
+
+def reads_during_import(user, rows=IMPORT_ROWS):
+    """Page reads per second while an import is running, and then without one
+
+    The import runs in a thread with its own connections and commits a chunk
+    at a time, like a queued upload. Reads skip the in-process cache layer,
+    so they go to the database. Returns a dict for each case with the number
+    of reads, reads per second, failed reads, and read times in seconds.
+    """
+    client = Client()
+    client.force_login(user)
+    account = Account.objects.filter(user=user).first()
+    urls = [reverse("summary"), reverse("account-detail", args=[account.pk])]
+    csv = synthetic.csv(rows, seed=1)
+
+    # Fill the shared cache, so reads don't write to it
+    for url in urls:
+        client.get(url)
+
+    def read(times, errors):
+        for url in urls:
+            if hasattr(caches["default"], "clear_local"):
+                caches["default"].clear_local()
+            start = perf_counter()
+            try:
+                client.get(url)
+            except OperationalError:
+                errors.append(url)
+            times.append(perf_counter() - start)
+
+    failed = []
+
+    def load():
+        try:
+            load_entries(account, csv, progress=lambda **counts: None)
+        except Exception as e:
+            failed.append(e)
+        finally:
+            connections.close_all()
+
+    times, errors = [], []
+    thread = Thread(target=load)
+    start = perf_counter()
+    thread.start()
+    while thread.is_alive():
+        read(times, errors)
+    thread.join()
+    import_seconds = perf_counter() - start
+    if failed:
+        raise failed[0]
+    results = [_reads("reads:during_import", times, errors, import_seconds)]
+    results[0]["import_seconds"] = import_seconds
+
+    # The same amount of time without the import
+    times, errors = [], []
+    start = perf_counter()
+    while perf_counter() - start < import_seconds:
+        read(times, errors)
+    results.append(_reads("reads:idle", times, errors, perf_counter() - start))
+
+    return results
+
+
+def _reads(name, times, errors, seconds):
+    return {
+        "name": name,
+        "reads": len(times),
+        "per_second": len(times) / seconds,
+        "errors": len(errors),
+        "min": min(times),
+        "median": median(times),
+        "mean": mean(times),
+        "max": max(times),
+    }
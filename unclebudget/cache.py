@@ -1,13 +1,15 @@
 from django.core.cache import cache
 
-from . import models
+from . import ledger, models
 
 
 ACCOUNT_BALANCE_KEY = "account:{account.pk}:balance"
 ENVELOPE_BALANCE_KEY = "envelope:{envelope.pk}:balance"
-ITEM_DATE_KEY = "item:{item.pk}:date"
 SKIPPED_ENTRIES_KEY = "user:{user.pk}:skipped_entries"
-UNBALANCED_ENTRIES_KEY = "user:{user.pk}:unbalanced_entries"
+USER_DATA_KEY = "user:{user.pk}:user_data"
+
+# Bump this when UserData's fields change, so stale pickles aren't used
+USER_DATA_VERSION = 1
 
 
 def get_account_balance(account):
@@ -21,6 +23,14 @@ def get_account_balance(account):
     return balance
 
 
+def get_account_balances(accounts):
+    """Balances of accounts by pk, with one cache round-trip and at most one
+    query for the ones that weren't cached"""
+    return _get_balances(
+        ACCOUNT_BALANCE_KEY, "account", accounts, ledger.account_balances
+    )
+
+
 def clear_account_balance(account):
     cache_key = ACCOUNT_BALANCE_KEY.format(account=account)
     cache.delete(cache_key)
@@ -37,24 +47,33 @@ def get_envelope_balance(envelope):
     return balance
 
 
-def clear_envelope_balance(envelope):
-    cache_key = ENVELOPE_BALANCE_KEY.format(envelope=envelope)
-    cache.delete(cache_key)
+def get_envelope_balances(envelopes):
+    """Balances of envelopes by pk, with one cache round-trip and at most one
+    query for the ones that weren't cached"""
+    return _get_balances(
+        ENVELOPE_BALANCE_KEY, "envelope", envelopes, ledger.envelope_balances
+    )
 
 
-def get_item_date(item):
-    cache_key = ITEM_DATE_KEY.format(item=item)
-    date = cache.get(cache_key)
+def _get_balances(key, name, objects, calculate):
+    keys = {key.format(**{name: obj}): obj for obj in objects}
+    cached = cache.get_many(keys)
 
-    if date == None:
-        date = item.entry.date
-        cache.set(cache_key, date, None)
+    balances = {keys[cache_key].pk: balance for cache_key, balance in cached.items()}
 
-    return date
+    missing = [obj for cache_key, obj in keys.items() if cache_key not in cached]
+    if missing:
+        calculated = calculate(missing)
+        cache.set_many(
+            {key.format(**{name: obj}): calculated[obj.pk] for obj in missing}, None
+        )
+        balances.update(calculated)
+
+    return balances
 
 
-def clear_item_date(item):
-    cache_key = ITEM_DATE_KEY.format(item=item)
+def clear_envelope_balance(envelope):
+    cache_key = ENVELOPE_BALANCE_KEY.format(envelope=envelope)
     cache.delete(cache_key)
 
 
@@ -81,19 +100,17 @@ def clear_skipped_entries(user):
     cache.delete(cache_key)
 
 
-def get_unbalanced_entries(user):
-    cache_key = UNBALANCED_ENTRIES_KEY.format(user=user)
-    unbalanced = cache.get(cache_key)
+def get_user_data(user):
+    cache_key = USER_DATA_KEY.format(user=user)
+    user_data = cache.get(cache_key, version=USER_DATA_VERSION)
 
-    if unbalanced == None:
-        unbalanced = set(
-            [e for e in models.Entry.objects.filter(user=user) if not e.balanced]
-        )
-        cache.set(cache_key, unbalanced, None)
+    if user_data == None:
+        user_data = models.UserData.objects.for_user(user)
+        cache.set(cache_key, user_data, None, version=USER_DATA_VERSION)
 
-    return unbalanced
+    return user_data
 
 
-def set_unbalanced_entries(user, entries):
-    cache_key = UNBALANCED_ENTRIES_KEY.format(user=user)
-    cache.set(cache_key, entries, None)
+def clear_user_data(user):
+    cache_key = USER_DATA_KEY.format(user=user)
+    cache.delete(cache_key, version=USER_DATA_VERSION)
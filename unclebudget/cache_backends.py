@@ -0,0 +1,288 @@
+import base64
+import pickle
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime, timezone
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends import db
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.db import DatabaseError, connections, router
+from django.utils.functional import cached_property
+from django.utils.timezone import now as tz_now
+
+# Django creates a cache backend per thread, so keep the local layer (and its
+# counters) at module level, keyed by LOCATION, like LocMemCache does
+_locals = {}
+_locks = {}
+_counters = {}
+
+
+def key_family(key):
+    """Family of a cache key, which is the key without its IDs
+
+    For example, account:12:balance is in the account:balance family.
+    """
+    return ":".join(part for part in key.split(":") if not part.isdigit())
+
+
+class LayeredCache(BaseCache):
+    """In-process LRU cache in front of a shared cache
+
+    LOCATION is the alias of the shared cache. Each key family gets its own
+    LRU, so one family can't push another out. OPTIONS:
+
+    MAX_ENTRIES: default size of each family's LRU
+    LOCAL_TIMEOUT: seconds a value is trusted locally before going back to
+        the shared cache (default 5). Deleting or setting a key only reaches
+        this process's local layer, so with several processes this is how
+        stale a value can get after another process changes it. 0 turns the
+        local layer off.
+    FAMILIES: per-family overrides of MAX_ENTRIES, and SHARED to keep a
+        family in a different shared cache
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+
+        self._shared_alias = location
+        self._local_timeout = options.get("LOCAL_TIMEOUT", 5)
+        self._families = options.get("FAMILIES", {})
+
+        self._local = _locals.setdefault(location, defaultdict(OrderedDict))
+        self._lock = _locks.setdefault(location, Lock())
+        self.local_hits, self.shared_hits, self.misses = _counters.setdefault(
+            location, (Counter(), Counter(), Counter())
+        )
+
+    def _shared(self, family):
+        alias = self._families.get(family, {}).get("SHARED", self._shared_alias)
+        return caches[alias]
+
+    @cached_property
+    def _shared_aliases(self):
+        return {self._shared_alias} | {
+            options["SHARED"]
+            for options in self._families.values()
+            if "SHARED" in options
+        }
+
+    def _family_max_entries(self, family):
+        return self._families.get(family, {}).get("MAX_ENTRIES", self._max_entries)
+
+    def _local_expiry(self, timeout):
+        expiry = self.get_backend_timeout(timeout)
+        if self._local_timeout is not None:
+            local_expiry = time() + self._local_timeout
+            if expiry is None or local_expiry < expiry:
+                expiry = local_expiry
+        return expiry
+
+    def _get_local(self, family, local_key):
+        with self._lock:
+            lru = self._local[family]
+            if local_key not in lru:
+                return False, None
+
+            expiry, pickled = lru[local_key]
+            if expiry is not None and expiry <= time():
+                del lru[local_key]
+                return False, None
+
+            lru.move_to_end(local_key)
+        return True, pickle.loads(pickled)
+
+    def _set_local(self, family, local_key, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            lru = self._local[family]
+            lru[local_key] = (self._local_expiry(timeout), pickled)
+            lru.move_to_end(local_key)
+            while len(lru) > self._family_max_entries(family):
+                lru.popitem(last=False)
+
+    def _delete_local(self, family, local_key):
+        with self._lock:
+            self._local[family].pop(local_key, None)
+
+    def _local_key(self, key, version):
+        return self.make_and_validate_key(key, version=version)
+
+    def stats(self):
+        """Hit and miss counts for each key family"""
+        families = set(self.local_hits) | set(self.shared_hits) | set(self.misses)
+        return {
+            family: {
+                "local_hits": self.local_hits[family],
+                "shared_hits": self.shared_hits[family],
+                "misses": self.misses[family],
+            }
+            for family in sorted(families)
+        }
+
+    def get(self, key, default=None, version=None):
+        family = key_family(key)
+        local_key = self._local_key(key, version)
+
+        found, value = self._get_local(family, local_key)
+        if found:
+            self.local_hits[family] += 1
+            return value
+
+        missing = object()
+        value = self._shared(family).get(key, missing, version=version)
+        if value is missing:
+            self.misses[family] += 1
+            return default
+
+        self.shared_hits[family] += 1
+        self._set_local(family, local_key, value, DEFAULT_TIMEOUT)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        by_family = defaultdict(list)
+        for key in keys:
+            family = key_family(key)
+            hit, value = self._get_local(family, self._local_key(key, version))
+            if hit:
+                self.local_hits[family] += 1
+                found[key] = value
+            else:
+                by_family[family].append(key)
+
+        for family, family_keys in by_family.items():
+            shared = self._shared(family).get_many(family_keys, version=version)
+            for key in family_keys:
+                if key not in shared:
+                    self.misses[family] += 1
+                    continue
+
+                self.shared_hits[family] += 1
+                found[key] = shared[key]
+                self._set_local(
+                    family, self._local_key(key, version), shared[key], DEFAULT_TIMEOUT
+                )
+
+        return found
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        family = key_family(key)
+        added = self._shared(family).add(key, value, timeout, version=version)
+        if added:
+            self._set_local(family, self._local_key(key, version), value, timeout)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        family = key_family(key)
+        self._shared(family).set(key, value, timeout, version=version)
+        self._set_local(family, self._local_key(key, version), value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        by_family = defaultdict(dict)
+        for key, value in data.items():
+            by_family[key_family(key)][key] = value
+
+        failed = []
+        for family, family_data in by_family.items():
+            failed += self._shared(family).set_many(
+                family_data, timeout, version=version
+            )
+            for key, value in family_data.items():
+                if key not in failed:
+                    self._set_local(
+                        family, self._local_key(key, version), value, timeout
+                    )
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        family = key_family(key)
+        self._delete_local(family, self._local_key(key, version))
+        return self._shared(family).touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        family = key_family(key)
+        self._delete_local(family, self._local_key(key, version))
+        return self._shared(family).delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        by_family = defaultdict(list)
+        for key in keys:
+            family = key_family(key)
+            self._delete_local(family, self._local_key(key, version))
+            by_family[family].append(key)
+
+        for family, family_keys in by_family.items():
+            self._shared(family).delete_many(family_keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, self, version=version) is not self
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+        for alias in self._shared_aliases:
+            caches[alias].clear()
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+
+class DatabaseCache(db.DatabaseCache):
+    """Django's database cache, with set_many in one statement
+
+    Django's version sets each key on its own, which costs a count, a select
+    and a write per key, so filling a page's balances took queries per
+    envelope. This upserts them all at once on databases that support it.
+    """
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        if not data or connection.vendor not in ("postgresql", "sqlite"):
+            return super().set_many(data, timeout, version=version)
+
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            expires = datetime.max
+        else:
+            tz = timezone.utc if settings.USE_TZ else None
+            expires = datetime.fromtimestamp(timeout, tz=tz)
+        expires = connection.ops.adapt_datetimefield_value(
+            expires.replace(microsecond=0)
+        )
+
+        params = []
+        for key, value in data.items():
+            pickled = pickle.dumps(value, self.pickle_protocol)
+            params += [
+                self.make_and_validate_key(key, version=version),
+                base64.b64encode(pickled).decode("latin1"),
+                expires,
+            ]
+
+        quote_name = connection.ops.quote_name
+        table = quote_name(self._table)
+        key, value, expires = (quote_name(c) for c in ("cache_key", "value", "expires"))
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM %s" % table)
+                num = cursor.fetchone()[0]
+                if num > self._max_entries:
+                    self._cull(db, cursor, tz_now().replace(microsecond=0), num)
+
+                cursor.execute(
+                    f"INSERT INTO {table} ({key}, {value}, {expires}) "
+                    f"VALUES {', '.join(['(%s, %s, %s)'] * len(data))} "
+                    f"ON CONFLICT ({key}) DO UPDATE SET "
+                    f"{value} = excluded.{value}, {expires} = excluded.{expires}",
+                    params,
+                )
+        except DatabaseError:
+            # Like set(), fail quietly and let the values be recalculated
+            return list(data)
+        return []
@@ -1,7 +1,5 @@
 from django.conf import settings
 
-from .models import UserData
-
 
 def debug(request):
     if settings.DEBUG:
@@ -11,7 +9,7 @@ def debug(request):
 
 def theme(request):
     if not request.user.is_anonymous:
-        dark_mode = UserData.objects.for_user(request.user).dark_mode
+        dark_mode = request.user_data.dark_mode
     else:
         dark_mode = True
 
@@ -0,0 +1,200 @@
+from datetime import timedelta
+import logging
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .loader import LoadException, load_entries
+from .models import ImportJob
+
+logger = logging.getLogger(__name__)
+
+# The import thread, if one is running in this process. _wake is set when a
+# job is queued, so a thread that's about to finish checks for it first.
+_lock = Lock()
+_thread = None
+_wake = Event()
+
+
+def enqueue(account, csv):
+    """Queue csv, text or a binary file, to be loaded into account
+
+    UNCLEBUDGET_IMPORT_MODE decides where the job runs: "thread" runs it in
+    a thread in this process once the request's transaction commits,
+    "worker" leaves it for the runimports command, and "inline" runs it
+    right away.
+    """
+    if isinstance(csv, str):
+        csv = csv.encode()
+    if isinstance(csv, bytes):
+        csv = ContentFile(csv)
+    if not isinstance(csv, File):
+        csv = File(csv)
+
+    # Storage copies the file a chunk at a time, or moves a temporary upload
+    job = ImportJob(account=account, user=account.user)
+    job.csv.save("upload.csv", csv, save=False)
+    job.save()
+
+    mode = settings.UNCLEBUDGET_IMPORT_MODE
+    if mode == "inline":
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.Status.RUNNING, heartbeat=timezone.now()
+        )
+        run(job)
+    elif mode == "thread":
+        transaction.on_commit(start_thread)
+
+    return job
+
+
+def claim():
+    """Mark the oldest queued job as running and return it, or None"""
+    queued = ImportJob.objects.filter(status=ImportJob.Status.QUEUED)
+    while job := queued.order_by("timestamp").select_related("account").first():
+        # Another worker may have got to it first
+        heartbeat = timezone.now()
+        if queued.filter(pk=job.pk).update(
+            status=ImportJob.Status.RUNNING, heartbeat=heartbeat
+        ):
+            job.status = ImportJob.Status.RUNNING
+            job.heartbeat = heartbeat
+            return job
+    return None
+
+
+def _stale_before():
+    return timezone.now() - timedelta(seconds=settings.UNCLEBUDGET_IMPORT_STALE_SECONDS)
+
+
+def is_stale(job):
+    """Whether job is running, but its worker has stopped"""
+    return job.status == ImportJob.Status.RUNNING and (
+        job.heartbeat is None or job.heartbeat < _stale_before()
+    )
+
+
+def requeue_stale():
+    """Queue jobs whose worker stopped while running them again
+
+    A worker has stopped if it hasn't committed a chunk in
+    UNCLEBUDGET_IMPORT_STALE_SECONDS. Jobs that had committed some chunks
+    fail instead, keeping their partial load and dropping their file;
+    uploading the file again loads the rest, with the loaded rows counted as
+    duplicates. Returns the number of jobs requeued or failed.
+    """
+    stale = ImportJob.objects.filter(
+        Q(heartbeat=None) | Q(heartbeat__lt=_stale_before()),
+        status=ImportJob.Status.RUNNING,
+    )
+    requeued = stale.filter(load=None).update(
+        status=ImportJob.Status.QUEUED, heartbeat=None
+    )
+    failed = 0
+    for job in stale:
+        # Its worker may have committed another chunk since
+        if stale.filter(pk=job.pk).update(
+            status=ImportJob.Status.FAILED,
+            error="The import was interrupted; upload the file again to load the rest",
+            csv="",
+        ):
+            job.csv.delete(save=False)
+            failed += 1
+    return requeued + failed
+
+
+def recover():
+    """Requeue stale jobs, and start the import thread if any are queued
+
+    Run as the web process starts, so jobs left by a process that stopped
+    don't wait for the next upload.
+    """
+    try:
+        requeue_stale()
+        pending = ImportJob.objects.filter(status=ImportJob.Status.QUEUED).exists()
+    except DatabaseError:
+        # Most likely the database isn't migrated yet
+        logger.warning("Couldn't check for pending imports", exc_info=True)
+        return
+
+    if pending and settings.UNCLEBUDGET_IMPORT_MODE == "thread":
+        start_thread()
+
+
+def run(job):
+    """Load a claimed job's CSV, recording progress on the job as it goes"""
+
+    def progress(**counts):
+        counts["heartbeat"] = timezone.now()
+        ImportJob.objects.filter(pk=job.pk).update(**counts)
+        for field, count in counts.items():
+            setattr(job, field, count)
+
+    start_time = perf_counter()
+    try:
+        with job.csv.open("rb") as file:
+            load, _ = load_entries(job.account, file, progress=progress)
+    except Exception as e:
+        # A file no loader understands is the user's problem, not ours
+        if not isinstance(e, LoadException):
+            logger.exception("Import job %d failed", job.pk)
+        # load_entries has undone any chunks it committed
+        job.status = ImportJob.Status.FAILED
+        job.error = str(e)
+        job.load = None
+    else:
+        if not job.inserted and not job.matched:
+            load.delete()
+            load = None
+
+        job.status = ImportJob.Status.DONE
+        job.load = load
+        job.seconds = perf_counter() - start_time
+
+    # Either way the file isn't needed again
+    job.csv.delete(save=False)
+    job.csv = ""
+    job.save(update_fields=["status", "error", "load", "csv", "seconds"])
+
+
+def run_pending():
+    """Run queued jobs until there are none left, and return how many ran"""
+    count = 0
+    while job := claim():
+        run(job)
+        count += 1
+    return count
+
+
+def start_thread():
+    """Start a thread to run queued jobs, unless one is already running"""
+    global _thread
+    with _lock:
+        _wake.set()
+        if _thread is None:
+            _thread = Thread(target=_work, name="unclebudget-imports", daemon=True)
+            _thread.start()
+
+
+def _work():
+    global _thread
+    try:
+        while True:
+            _wake.clear()
+            run_pending()
+            with _lock:
+                if not _wake.is_set():
+                    _thread = None
+                    return
+    except Exception:
+        logger.exception("Import thread failed")
+        with _lock:
+            _thread = None
+    finally:
+        connections.close_all()
@@ -0,0 +1,391 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+
+from django.db.models import BigIntegerField, Count, F, Q, Sum
+from django.db.models.functions import Cast, Coalesce, ExtractMonth, ExtractYear, Round
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import cache, models
+
+# Balances are stored as integer cents so they can be updated with plain SQL
+# arithmetic; sqlite3 doesn't have a decimal type, so this keeps them exact
+
+# EnvelopeMonth's totals, in the order month deltas list them
+MONTH_FIELDS = ("income_cents", "income_count", "expense_cents", "expense_count")
+
+
+def to_cents(amount):
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(Decimal("0.01"))
+
+
+def cents(field):
+    """Expression for a decimal field in integer cents, for exact sums in SQL"""
+    return Cast(Round(F(field) * 100), BigIntegerField())
+
+
+def account_balance(account):
+    cents = (
+        models.AccountBalance.objects.filter(account=account)
+        .values_list("cents", flat=True)
+        .first()
+    )
+    return from_cents(cents or 0)
+
+
+def envelope_balance(envelope):
+    cents = (
+        models.EnvelopeBalance.objects.filter(envelope=envelope)
+        .values_list("cents", flat=True)
+        .first()
+    )
+    return from_cents(cents or 0)
+
+
+def account_balances(accounts):
+    cents = dict(
+        models.AccountBalance.objects.filter(account__in=accounts).values_list(
+            "account_id", "cents"
+        )
+    )
+    return {account.pk: from_cents(cents.get(account.pk, 0)) for account in accounts}
+
+
+def envelope_balances(envelopes):
+    cents = dict(
+        models.EnvelopeBalance.objects.filter(envelope__in=envelopes).values_list(
+            "envelope_id", "cents"
+        )
+    )
+    return {
+        envelope.pk: from_cents(cents.get(envelope.pk, 0)) for envelope in envelopes
+    }
+
+
+def _entry_cents(entry):
+    # Expected entries haven't hit the account yet
+    if entry.expected:
+        return 0
+    return -to_cents(entry.amount)
+
+
+def _item_cents(item):
+    return -to_cents(item.amount)
+
+
+def _apply(model, key, deltas, create):
+    for pk, cents in deltas.items():
+        if not cents:
+            continue
+
+        updated = model.objects.filter(**{key: pk}).update(cents=F("cents") + cents)
+        if not updated and create:
+            model.objects.create(**{key: pk, "cents": cents})
+
+
+def update_account_balances(added=(), removed=(), create=True):
+    deltas = defaultdict(int)
+    for entry in added:
+        deltas[entry.account_id] += _entry_cents(entry)
+    for entry in removed:
+        deltas[entry.account_id] -= _entry_cents(entry)
+
+    _apply(models.AccountBalance, "account_id", deltas, create)
+
+
+def update_envelope_balances(added=(), removed=(), create=True):
+    """Add and remove items from envelope balances and monthly totals"""
+    deltas = defaultdict(int)
+    for item in added:
+        deltas[item.envelope_id] += _item_cents(item)
+    for item in removed:
+        deltas[item.envelope_id] -= _item_cents(item)
+
+    _apply(models.EnvelopeBalance, "envelope_id", deltas, create)
+    update_envelope_months(added, removed, create)
+
+
+def update_envelope_months(added=(), removed=(), create=True):
+    deltas = defaultdict(lambda: [0] * len(MONTH_FIELDS))
+    for sign, items in ((1, added), (-1, removed)):
+        for item in items:
+            cents = sign * to_cents(item.amount)
+            if not item.amount:
+                continue
+
+            key = (item.envelope_id, item.date.replace(day=1), item.user_id)
+            # Income is negative, expenses positive
+            offset = 0 if item.amount < 0 else 2
+            deltas[key][offset] += cents
+            deltas[key][offset + 1] += sign
+
+    _apply_months(deltas, create)
+
+
+def _apply_months(deltas, create):
+    for (envelope_id, month, user_id), values in deltas.items():
+        if not any(values):
+            continue
+
+        updated = models.EnvelopeMonth.objects.filter(
+            envelope_id=envelope_id, month=month
+        ).update(
+            **{field: F(field) + value for field, value in zip(MONTH_FIELDS, values)}
+        )
+        if not updated and create:
+            models.EnvelopeMonth.objects.create(
+                envelope_id=envelope_id,
+                month=month,
+                user_id=user_id,
+                **dict(zip(MONTH_FIELDS, values)),
+            )
+
+
+def _month_totals(items):
+    """Monthly totals of a queryset of items, keyed like month deltas"""
+    totals = {}
+    for row in (
+        items.order_by()
+        .values(
+            "envelope_id",
+            "user_id",
+            year=ExtractYear("date"),
+            month=ExtractMonth("date"),
+        )
+        .annotate(
+            income_cents=Coalesce(Sum(cents("amount"), filter=Q(amount__lt=0)), 0),
+            income_count=Count("pk", filter=Q(amount__lt=0)),
+            expense_cents=Coalesce(Sum(cents("amount"), filter=Q(amount__gt=0)), 0),
+            expense_count=Count("pk", filter=Q(amount__gt=0)),
+        )
+    ):
+        key = (row["envelope_id"], date(row["year"], row["month"], 1), row["user_id"])
+        totals[key] = [row[field] for field in MONTH_FIELDS]
+    return totals
+
+
+def redate_items(items):
+    """Give items their entries' dates, moving them between monthly totals"""
+    moved = []
+    previous = []
+    for item in items:
+        if item.date == item.entry.date:
+            continue
+
+        previous.append(
+            models.Item(
+                amount=item.amount,
+                date=item.date,
+                envelope_id=item.envelope_id,
+                user_id=item.user_id,
+            )
+        )
+        item.date = item.entry.date
+        moved.append(item)
+
+    models.Item.objects.bulk_update(moved, ["date"])
+    update_envelope_months(added=moved, removed=previous)
+
+
+def remove_entries(entries):
+    """Take a queryset of entries and their items off the stored balances
+
+    For deleting entries in bulk without the post_delete receivers. Returns
+    the pks of the affected accounts and envelopes.
+    """
+    return _remove(entries, models.Item.objects.filter(entry__in=entries))
+
+
+def _remove(entries, items):
+    account_deltas = _sum_cents(entries.filter(expected=False), "account_id")
+    envelope_deltas = _sum_cents(items, "envelope_id")
+    month_deltas = {
+        key: [-value for value in values]
+        for key, values in _month_totals(items).items()
+    }
+
+    _apply(models.AccountBalance, "account_id", account_deltas, False)
+    _apply(models.EnvelopeBalance, "envelope_id", envelope_deltas, False)
+    _apply_months(month_deltas, False)
+
+    return set(account_deltas), set(envelope_deltas)
+
+
+def _sum_cents(queryset, key):
+    # Removing rows undoes their -amount contributions
+    return dict(
+        queryset.order_by().values_list(key).annotate(cents=Sum(cents("amount")))
+    )
+
+
+# Deletes are handled with signals so cascades and queryset deletes are
+# counted too. They never create rows, since the account or envelope may be
+# going away in the same delete.
+
+# Models whose deletes cascade to entries or items. The origin of such a
+# delete takes everything it cascades to off the ledger at once from its
+# pre_delete, inside the delete's transaction, and the post_delete receivers
+# skip those rows, instead of costing a few queries each.
+CASCADE_ORIGINS = (
+    "auth.User",
+    "unclebudget.Account",
+    "unclebudget.Entry",
+    "unclebudget.Envelope",
+)
+
+
+def _cascaded(instance, origin):
+    """Whether instance is going in a cascade its origin took care of"""
+    return (
+        origin is not instance
+        and getattr(origin, "_meta", None) is not None
+        and origin._meta.label in CASCADE_ORIGINS
+    )
+
+
+def cascade_deleting(sender, instance, origin=None, **kwargs):
+    # pre_delete is sent for every row in the cascade, but only the origin
+    # knows what the cascade covers
+    if origin is not instance:
+        return
+
+    if isinstance(instance, models.Account):
+        entries = models.Entry.objects.filter(account=instance)
+        items = models.Item.objects.filter(entry__account=instance)
+    elif isinstance(instance, models.Entry):
+        # entry_deleted takes the entry itself off
+        entries = models.Entry.objects.none()
+        items = instance.item_set.all()
+    elif isinstance(instance, models.Envelope):
+        # Its balance and monthly totals go with it, but its items' entries
+        # stay, so they may be unbalanced without them
+        models.Entry.objects.refresh_unbalanced(
+            set(instance.item_set.values_list("entry_id", flat=True)),
+            without_envelope=instance,
+        )
+        return
+    else:
+        # A user's accounts, envelopes and balances all go with them
+        return
+
+    accounts, envelopes = _remove(entries, items)
+    for pk in accounts:
+        cache.clear_account_balance(models.Account(pk=pk))
+    for pk in envelopes:
+        cache.clear_envelope_balance(models.Envelope(pk=pk))
+
+
+for label in CASCADE_ORIGINS:
+    pre_delete.connect(cascade_deleting, sender=label)
+
+
+@receiver(post_delete, sender="unclebudget.Entry")
+def entry_deleted(sender, instance, origin=None, **kwargs):
+    if _cascaded(instance, origin):
+        return
+
+    update_account_balances(removed=[instance], create=False)
+    cache.clear_account_balance(models.Account(pk=instance.account_id))
+
+
+@receiver(post_delete, sender="unclebudget.Item")
+def item_deleted(sender, instance, origin=None, **kwargs):
+    if _cascaded(instance, origin):
+        return
+
+    update_envelope_balances(removed=[instance], create=False)
+    cache.clear_envelope_balance(models.Envelope(pk=instance.envelope_id))
+
+    # The entry is already gone if this is part of its own delete
+    models.Entry.objects.refresh_unbalanced([instance.entry_id])
+
+
+def rebuild(fix=True):
+    """Recalculate every stored balance from entries and items
+
+    Returns a list of (model, pk, stored, actual) for each balance that was
+    wrong. If fix is set, wrong balances are corrected.
+    """
+    mismatches = []
+
+    for model, key, rows in (
+        (
+            models.AccountBalance,
+            "account_id",
+            models.Entry.objects.filter(expected=False).values_list(
+                "account_id", "amount"
+            ),
+        ),
+        (
+            models.EnvelopeBalance,
+            "envelope_id",
+            models.Item.objects.values_list("envelope_id", "amount"),
+        ),
+    ):
+        parent = model._meta.get_field(key.removesuffix("_id")).related_model
+
+        actual = {pk: 0 for pk in parent.objects.values_list("pk", flat=True)}
+        for pk, amount in rows:
+            actual[pk] -= to_cents(amount)
+
+        stored = dict(model.objects.values_list(key, "cents"))
+
+        for pk, cents in actual.items():
+            if stored.get(pk, 0) == cents:
+                continue
+
+            mismatches.append((model, pk, stored.get(pk, 0), cents))
+            if fix:
+                model.objects.update_or_create(**{key: pk}, defaults={"cents": cents})
+
+    return mismatches
+
+
+def rebuild_months(fix=True):
+    """Recalculate every monthly envelope total from items
+
+    Returns a list of (envelope pk, month, stored, actual) for each month
+    that was wrong, with the totals as tuples in MONTH_FIELDS order. If fix
+    is set, wrong months are corrected.
+    """
+    actual = _month_totals(models.Item.objects.all())
+    stored = {
+        (envelope_id, month, user_id): list(values)
+        for envelope_id, month, user_id, *values in (
+            models.EnvelopeMonth.objects.values_list(
+                "envelope_id", "month", "user_id", *MONTH_FIELDS
+            )
+        )
+    }
+
+    mismatches = []
+    zero = [0] * len(MONTH_FIELDS)
+    for key in sorted(actual.keys() | stored.keys()):
+        envelope_id, month, user_id = key
+        if stored.get(key, zero) == actual.get(key, zero):
+            continue
+
+        mismatches.append(
+            (
+                envelope_id,
+                month,
+                tuple(stored.get(key, zero)),
+                tuple(actual.get(key, zero)),
+            )
+        )
+        if fix:
+            models.EnvelopeMonth.objects.update_or_create(
+                envelope_id=envelope_id,
+                month=month,
+                defaults={
+                    "user_id": user_id,
+                    **dict(zip(MONTH_FIELDS, actual.get(key, zero))),
+                },
+            )
+
+    return mismatches
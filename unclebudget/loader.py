@@ -1,84 +1,257 @@
+from collections import defaultdict
+from contextlib import nullcontext
+from csv import DictReader, reader
 from importlib import import_module
-from io import StringIO
+from io import StringIO, TextIOWrapper
+from itertools import islice
+import logging
+from time import perf_counter
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 
+from . import cache, ledger
 from .models import *
 
+logger = logging.getLogger(__name__)
+
+# Number of parsed charges matched and inserted at a time
+CHUNK_SIZE = 500
+
+
+# Loader modules by the CSV header they accept, filled in by register_loaders
+LOADERS = {}
+
 
 class LoadException(Exception):
     pass
 
 
-def load_entries(account, text):
-    user_data = UserData.objects.for_user(account.user)
+def register_loaders():
+    LOADERS.clear()
+    for loader in settings.UNCLEBUDGET_LOADERS:
+        module = import_module(loader)
+        header = tuple(module.HEADER)
 
-    charges = None
+        if header in LOADERS:
+            raise ImproperlyConfigured(
+                f"{loader} and {LOADERS[header][0]} both load {list(header)}"
+            )
 
-    if type(text) == bytes:
-        text = text.decode()
+        LOADERS[header] = (loader, module)
 
-    for loader in settings.UNCLEBUDGET_LOADERS:
+
+def _open(csv):
+    if type(csv) == bytes:
+        csv = csv.decode()
+    if type(csv) == str:
+        return StringIO(csv)
+
+    # Uploaded files are binary; decode them as they're read
+    return TextIOWrapper(getattr(csv, "file", csv), encoding="utf-8-sig", newline="")
+
+
+def _recorded(file, lines):
+    for line in file:
+        lines.append(line)
+        yield line
+
+
+def load_entries(account, csv, user_data=None, progress=None):
+    """Load entries into account from csv, which can be text or a binary file
+
+    The first line of the file picks the loader, and the rest is parsed and
+    loaded CHUNK_SIZE rows at a time.
+
+    The whole file is loaded in one transaction, unless progress is given.
+    Then each chunk is committed on its own, and progress is called inside
+    its transaction with the load and the running counts of rows, matched,
+    inserted and duplicates, so other connections see progress as it's
+    committed. If a later chunk fails, the committed ones are undone.
+    """
+    if user_data is None:
+        user_data = cache.get_user_data(account.user)
+
+    start_time = perf_counter()
+
+    # Load.text keeps a copy of the file, so collect lines as they're read
+    lines = []
+    file = _recorded(_open(csv), lines)
+
+    header = next(reader([next(file, "")]), [])
+    if header:
+        header[0] = header[0].lstrip("\ufeff")
+
+    try:
+        loader, module = LOADERS[tuple(header)]
+    except KeyError:
+        raise LoadException(f"No loader for columns {header}")
+
+    charges = module.load(DictReader(file, fieldnames=header))
+
+    with transaction.atomic() if progress is None else nullcontext():
+        # Saved with the first chunk, so a load interrupted before then leaves
+        # nothing behind
+        load = Load(loader=loader, user=account.user)
+
+        # Expected entries can match a charge from any date, so fetch them all
+        # up front
+        expected_by_amount = defaultdict(list)
+        originals = {}
+        for entry in Entry.objects.filter(account=account, expected=True):
+            expected_by_amount[entry.amount].append(entry)
+            originals[entry.pk] = (entry.date, entry.description)
+
+        rows = 0
+        matched = []
+        entries = []
+        small_change = []
+        duplicates = 0
         try:
-            charges = import_module(loader).load(StringIO(text))
-            break
+            while chunk := list(islice(charges, CHUNK_SIZE)):
+                rows += len(chunk)
+                chunk = [c for c in chunk if c.date >= account.start_date]
+
+                with transaction.atomic():
+                    if load.pk is None:
+                        load.save()
+
+                    chunk_matched, chunk_entries, chunk_small_change, chunk_dupes = (
+                        _load_chunk(account, load, user_data, chunk, expected_by_amount)
+                    )
+
+                    matched += chunk_matched
+                    entries += chunk_entries
+                    small_change += chunk_small_change
+                    duplicates += chunk_dupes
+
+                    if progress:
+                        progress(
+                            load=load,
+                            rows=rows,
+                            matched=len(matched),
+                            inserted=len(entries),
+                            duplicates=duplicates,
+                        )
         except Exception:
-            pass
+            if progress is not None:
+                _undo(load, originals)
+            raise
+
+        load.text = "".join(lines)
+        load.save()
+
+    cache.clear_account_balance(account)
+    if small_change:
+        cache.clear_envelope_balance(user_data.small_change_envelope)
+
+    elapsed = perf_counter() - start_time
+    logger.info(
+        "Loaded %d rows into %s in %.2fs (%.0f rows/sec): "
+        "%d new, %d expected, %d duplicates",
+        rows,
+        account,
+        elapsed,
+        rows / elapsed if elapsed else 0,
+        len(entries),
+        len(matched),
+        duplicates,
+    )
+
+    return load, entries
+
+
+def _undo(load, originals):
+    """Undo the committed chunks of a failed load, so it leaves no trace
 
-    if charges == None:
-        raise LoadException(f"No loaders successful")
+    originals has the dates and descriptions of the expected entries, by pk.
+    """
+    if load.pk is None:
+        return
 
-    load = Load(loader=loader, text=text, user=account.user)
-    load.save()
+    with transaction.atomic():
+        # Matched entries go back to being expected
+        for entry in Entry.objects.filter(load=load, pk__in=originals):
+            entry.date, entry.description = originals[entry.pk]
+            entry.expected = True
+            entry.load = None
+            entry.save()
 
+        load.delete()
+
+
+def _load_chunk(account, load, user_data, charges, expected_by_amount):
+    # Fetch everything the charges could duplicate up front, so matching
+    # doesn't cost any queries per charge. Entries from earlier chunks of
+    # this load don't count, since we assume a single CSV doesn't have
+    # duplicates.
+    existing = set()
+    if charges:
+        existing = set(
+            Entry.objects.filter(
+                account=account,
+                date__gte=min(charge.date for charge in charges),
+                date__lte=max(charge.date for charge in charges),
+            )
+            .exclude(load=load)
+            .values_list("date", "description", "amount")
+        )
+
+    matched = []
     entries = []
+    small_change = []
+    duplicates = 0
     for charge in charges:
-        if charge.date < account.start_date:
-            continue
-
         # Look for expected entries
-        expected = Entry.objects.filter(
-            account=account,
-            amount=charge.amount,
-            expected=True,
-        ).first()
-        if expected:
+        if expected_by_amount[charge.amount]:
+            expected = expected_by_amount[charge.amount].pop(0)
             expected.date = charge.date
             expected.description = charge.description
             expected.expected = False
             expected.load = load
-            expected.save()
+            matched.append(expected)
             continue
 
         # Look for duplicates
-        duplicate = False
-        for entry in Entry.objects.filter(
-            account=account,
-            date=charge.date,
-            description=charge.description,
-        ).all():
-            if entry.amount == charge.amount:
-                # We assume a single CSV doesn't have duplicates
-                if entry not in entries:
-                    duplicate = True
-        if duplicate:
+        if (charge.date, charge.description, charge.amount) in existing:
+            duplicates += 1
             continue
 
         charge.account = account
         charge.load = load
         charge.user = account.user
-        charge.save()
+        charge.unbalanced = charge.amount != 0
+        entries.append(charge)
 
         # Look for small change
         if user_data.small_change_envelope:
             if abs(charge.amount) < user_data.small_change_threshold:
-                Item.objects.create(
-                    amount=charge.amount,
-                    envelope=user_data.small_change_envelope,
-                    entry=charge,
-                    user=account.user,
-                )
+                small_change.append(charge)
+                charge.unbalanced = False
 
-        entries.append(charge)
+    Entry.objects.bulk_update(matched, ["date", "description", "expected", "load"])
+    Entry.objects.bulk_create(entries)
 
-    return load, entries
+    # Matched entries have new dates, so their items do too
+    ledger.redate_items(Item.objects.filter(entry__in=matched).select_related("entry"))
+
+    small_change = Item.objects.bulk_create(
+        [
+            Item(
+                amount=entry.amount,
+                date=entry.date,
+                description="",
+                envelope=user_data.small_change_envelope,
+                entry=entry,
+                user=account.user,
+            )
+            for entry in small_change
+        ]
+    )
+
+    # Expected entries didn't count towards the account balance before
+    ledger.update_account_balances(added=matched + entries)
+    ledger.update_envelope_balances(added=small_change)
+
+    return matched, entries, small_change, duplicates
@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+import json
+import platform
+import sqlite3
+from tempfile import TemporaryDirectory
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from unclebudget import benchmark, synthetic
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the views and the cache, stats and loader entry points on "
+        "synthetic ledgers of several sizes, in a throwaway database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 100000],
+            help="Numbers of entries to benchmark with",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--label", default="", help="Recorded with the results, like a commit"
+        )
+        parser.add_argument(
+            "--output", help="File to write the JSON results to, instead of stdout"
+        )
+
+    def handle(self, *args, **options):
+        report = {
+            "label": options["label"],
+            "started": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "seed": options["seed"],
+            "repeat": options["repeat"],
+            "results": [],
+        }
+        if connection.vendor == "sqlite":
+            report["sqlite"] = sqlite3.sqlite_version
+            report["sqlite_pragmas"] = settings.SQLITE_PRAGMAS
+
+        with TemporaryDirectory() as directory:
+            # Benchmark sqlite on disk, not the in-memory test default
+            for alias in connections:
+                test_settings = connections[alias].settings_dict["TEST"]
+                if connections[alias].vendor == "sqlite":
+                    test_settings["NAME"] = f"{directory}/{alias}.db"
+
+            setup_test_environment()
+            old_names = {
+                alias: connections[alias].creation.create_test_db(
+                    verbosity=0, autoclobber=True, serialize=False
+                )
+                for alias in connections
+            }
+            try:
+                for size in options["sizes"]:
+                    call_command("flush", interactive=False, verbosity=0)
+                    (user,) = synthetic.generate(entries=size, seed=options["seed"])
+
+                    for result in benchmark.run(user, options["repeat"]):
+                        report["results"].append({"size": size, **result})
+                        self.stderr.write(
+                            f"{size:>8} {result['name']:<36} "
+                            f"{result['median'] * 1000:9.1f}ms "
+                            f"{result['queries']:4} queries"
+                        )
+
+                    for result in benchmark.reads_during_import(user):
+                        report["results"].append({"size": size, **result})
+                        self.stderr.write(
+                            f"{size:>8} {result['name']:<36} "
+                            f"{result['per_second']:9.1f}/s "
+                            f"max {result['max'] * 1000:.1f}ms, "
+                            f"{result['errors']} errors"
+                        )
+            finally:
+                for alias, old_name in old_names.items():
+                    connections[alias].creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,57 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from unclebudget import synthetic
+
+
+class Command(BaseCommand):
+    help = "Create users with a deterministic synthetic ledger, for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1)
+        parser.add_argument("--accounts", type=int, default=3, help="Per user")
+        parser.add_argument("--envelopes", type=int, default=12, help="Per user")
+        parser.add_argument("--entries", type=int, default=100000, help="Per user")
+        parser.add_argument(
+            "--days", type=int, default=3 * 365, help="Days the entries span"
+        )
+        parser.add_argument(
+            "--end",
+            type=date.fromisoformat,
+            default=date(2025, 12, 31),
+            help="Date of the last day, as YYYY-MM-DD",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--prefix",
+            default="synthetic",
+            help="Usernames are the prefix followed by a number",
+        )
+        parser.add_argument("--password", help="Password for the new users")
+
+    def handle(self, *args, **options):
+        usernames = [f"{options['prefix']}{n}" for n in range(options["users"])]
+        if User.objects.filter(username__in=usernames).exists():
+            raise CommandError(
+                f"Users starting with {options['prefix']} already exist; "
+                "pick another --prefix"
+            )
+
+        users = synthetic.generate(
+            users=options["users"],
+            accounts=options["accounts"],
+            envelopes=options["envelopes"],
+            entries=options["entries"],
+            days=options["days"],
+            end=options["end"],
+            seed=options["seed"],
+            prefix=options["prefix"],
+        )
+
+        for user in users:
+            if options["password"]:
+                user.set_password(options["password"])
+                user.save(update_fields=["password"])
+            self.stdout.write(f"Created {user.username} (pk {user.pk})")
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from unclebudget import cache, ledger
+from unclebudget.models import Account, AccountBalance, Envelope
+
+
+class Command(BaseCommand):
+    help = "Recalculate stored account and envelope balances from the ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the stored balances; exit with an error if any are wrong",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            mismatches = ledger.rebuild(fix=not options["check"])
+
+        for model, pk, stored, actual in mismatches:
+            self.stdout.write(
+                f"{model.__name__} {pk}: stored {ledger.from_cents(stored)}, "
+                f"actual {ledger.from_cents(actual)}"
+            )
+
+        if options["check"]:
+            if mismatches:
+                raise CommandError(f"{len(mismatches)} balances are wrong")
+            self.stdout.write(self.style.SUCCESS("All balances are correct"))
+            return
+
+        # Cached balances may have been computed from the wrong values
+        for model, pk, _, _ in mismatches:
+            if model == AccountBalance:
+                cache.clear_account_balance(Account(pk=pk))
+            else:
+                cache.clear_envelope_balance(Envelope(pk=pk))
+
+        self.stdout.write(self.style.SUCCESS(f"Fixed {len(mismatches)} balances"))
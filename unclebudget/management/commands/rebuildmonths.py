@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from unclebudget import ledger
+
+
+class Command(BaseCommand):
+    help = "Recalculate the monthly envelope totals from the ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the monthly totals; exit with an error if any are wrong",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            mismatches = ledger.rebuild_months(fix=not options["check"])
+
+        for pk, month, stored, actual in mismatches:
+            self.stdout.write(
+                f"Envelope {pk} {month:%Y-%m}: stored {self._totals(stored)}, "
+                f"actual {self._totals(actual)}"
+            )
+
+        if options["check"]:
+            if mismatches:
+                raise CommandError(f"{len(mismatches)} monthly totals are wrong")
+            self.stdout.write(self.style.SUCCESS("All monthly totals are correct"))
+            return
+
+        self.stdout.write(self.style.SUCCESS(f"Fixed {len(mismatches)} monthly totals"))
+
+    def _totals(self, totals):
+        income_cents, income_count, expense_cents, expense_count = totals
+        return (
+            f"income {ledger.from_cents(income_cents)} ({income_count}), "
+            f"expenses {ledger.from_cents(expense_cents)} ({expense_count})"
+        )
@@ -0,0 +1,34 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from unclebudget import imports
+
+
+class Command(BaseCommand):
+    help = "Run queued CSV imports, for UNCLEBUDGET_IMPORT_MODE=worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting for more jobs",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2,
+            help="Seconds to wait between checks of an empty queue",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            stale = imports.requeue_stale()
+            if stale:
+                self.stdout.write(f"Requeued {stale} stopped imports")
+            count = imports.run_pending()
+            if count:
+                self.stdout.write(f"Ran {count} imports")
+            if options["once"]:
+                return
+            sleep(options["interval"])
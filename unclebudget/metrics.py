@@ -0,0 +1,184 @@
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.cache import caches
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Upper bounds of the request latency histogram buckets, in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    query_seconds: float = 0
+
+
+@dataclass
+class ViewStats:
+    requests: int = 0
+    seconds: float = 0
+    queries: int = 0
+    query_seconds: float = 0
+    buckets: list = field(default_factory=lambda: [0] * len(BUCKETS))
+
+
+# Stats for the request being handled. A context variable follows the
+# request into sync_to_async threads, so async views are counted too.
+_request = ContextVar("unclebudget_metrics_request", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_seconds += perf_counter() - start
+
+
+def _install(connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class Metrics:
+    """Request latency and query counts by view, for this process"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._views = defaultdict(ViewStats)
+
+    def record(self, view, seconds, stats):
+        with self._lock:
+            view_stats = self._views[view]
+            view_stats.requests += 1
+            view_stats.seconds += seconds
+            view_stats.queries += stats.queries
+            view_stats.query_seconds += stats.query_seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    view_stats.buckets[i] += 1
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def render(self):
+        """Metrics in the Prometheus text format"""
+        with self._lock:
+            views = sorted(self._views.items())
+
+        lines = [
+            "# HELP unclebudget_request_seconds Request latency by view",
+            "# TYPE unclebudget_request_seconds histogram",
+        ]
+        for view, stats in views:
+            for bound, count in zip(BUCKETS, stats.buckets):
+                lines.append(
+                    f'unclebudget_request_seconds_bucket{{view="{view}",le="{bound}"}}'
+                    f" {count}"
+                )
+            lines += [
+                f'unclebudget_request_seconds_bucket{{view="{view}",le="+Inf"}}'
+                f" {stats.requests}",
+                f'unclebudget_request_seconds_sum{{view="{view}"}} {stats.seconds}',
+                f'unclebudget_request_seconds_count{{view="{view}"}} {stats.requests}',
+            ]
+
+        lines += [
+            "# HELP unclebudget_db_queries_total Database queries by view",
+            "# TYPE unclebudget_db_queries_total counter",
+        ]
+        lines += [
+            f'unclebudget_db_queries_total{{view="{view}"}} {stats.queries}'
+            for view, stats in views
+        ]
+
+        lines += [
+            "# HELP unclebudget_db_query_seconds_total Time in database queries by view",
+            "# TYPE unclebudget_db_query_seconds_total counter",
+        ]
+        lines += [
+            f'unclebudget_db_query_seconds_total{{view="{view}"}} {stats.query_seconds}'
+            for view, stats in views
+        ]
+
+        # Only the layered cache keeps counts
+        cache = caches["default"]
+        if hasattr(cache, "stats"):
+            lines += [
+                "# HELP unclebudget_cache_requests_total Cache lookups by key family",
+                "# TYPE unclebudget_cache_requests_total counter",
+            ]
+            for family, counts in cache.stats().items():
+                for result, count in counts.items():
+                    lines.append(
+                        "unclebudget_cache_requests_total"
+                        f'{{family="{family}",result="{result}"}} {count}'
+                    )
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Metrics()
+
+
+class MetricsMiddleware:
+    """Record each request's latency and database queries by view
+
+    The totals are served by the metrics view. Each process keeps its own, so
+    with several workers a scrape only sees the worker that answered it.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+        connection_created.connect(_install, dispatch_uid="unclebudget.metrics")
+        for connection in connections.all(initialized_only=True):
+            _install(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            self._finish(request, stats, token, start)
+        return response
+
+    async def __acall__(self, request):
+        stats, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._finish(request, stats, token, start)
+        return response
+
+    def _start(self):
+        stats = RequestStats()
+        return stats, _request.set(stats), perf_counter()
+
+    def _finish(self, request, stats, token, start):
+        seconds = perf_counter() - start
+        _request.reset(token)
+
+        # Unmatched URLs share a label, so bad requests can't add new series
+        match = getattr(request, "resolver_match", None)
+        registry.record(match.view_name if match else "unmatched", seconds, stats)
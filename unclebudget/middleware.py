@@ -0,0 +1,43 @@
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.utils.functional import SimpleLazyObject
+
+from . import cache
+
+
+def get_user_data(request):
+    if not hasattr(request, "_cached_user_data"):
+        request._cached_user_data = cache.get_user_data(request.user)
+    return request._cached_user_data
+
+
+async def aget_user_data(request):
+    if not hasattr(request, "_cached_user_data"):
+        user = await request.auser()
+        request._cached_user_data = await sync_to_async(cache.get_user_data)(user)
+    return request._cached_user_data
+
+
+class UserDataMiddleware:
+    """Add the user's UserData to the request as request.user_data
+
+    It's loaded the first time it's used, at most once per request. Async
+    views use await request.auser_data() instead, like request.auser().
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        request.user_data = SimpleLazyObject(partial(get_user_data, request))
+        request.auser_data = partial(aget_user_data, request)
+
+        # In async mode this returns get_response's coroutine for the caller
+        # to await
+        return self.get_response(request)
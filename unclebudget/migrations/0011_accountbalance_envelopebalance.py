@@ -0,0 +1,75 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:55
+
+from collections import defaultdict
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_balances(apps, schema_editor):
+    Entry = apps.get_model("unclebudget", "Entry")
+    Item = apps.get_model("unclebudget", "Item")
+    AccountBalance = apps.get_model("unclebudget", "AccountBalance")
+    EnvelopeBalance = apps.get_model("unclebudget", "EnvelopeBalance")
+
+    accounts = defaultdict(int)
+    for account_id, amount in Entry.objects.filter(expected=False).values_list(
+        "account_id", "amount"
+    ):
+        accounts[account_id] -= int(Decimal(amount) * 100)
+
+    envelopes = defaultdict(int)
+    for envelope_id, amount in Item.objects.values_list("envelope_id", "amount"):
+        envelopes[envelope_id] -= int(Decimal(amount) * 100)
+
+    AccountBalance.objects.bulk_create(
+        [AccountBalance(account_id=pk, cents=cents) for pk, cents in accounts.items()]
+    )
+    EnvelopeBalance.objects.bulk_create(
+        [
+            EnvelopeBalance(envelope_id=pk, cents=cents)
+            for pk, cents in envelopes.items()
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("unclebudget", "0010_template_templateitem"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccountBalance",
+            fields=[
+                (
+                    "account",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="unclebudget.account",
+                    ),
+                ),
+                ("cents", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="EnvelopeBalance",
+            fields=[
+                (
+                    "envelope",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        serialize=False,
+                        to="unclebudget.envelope",
+                    ),
+                ),
+                ("cents", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:57
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_unbalanced(apps, schema_editor):
+    Entry = apps.get_model("unclebudget", "Entry")
+    Item = apps.get_model("unclebudget", "Item")
+
+    item_totals = defaultdict(Decimal)
+    for entry_id, amount in Item.objects.values_list("entry_id", "amount"):
+        item_totals[entry_id] += amount
+
+    unbalanced = [
+        pk
+        for pk, amount in Entry.objects.values_list("pk", "amount")
+        if amount != item_totals[pk]
+    ]
+
+    # Stay under sqlite's limit on query parameters
+    for i in range(0, len(unbalanced), 500):
+        Entry.objects.filter(pk__in=unbalanced[i : i + 500]).update(unbalanced=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("unclebudget", "0011_accountbalance_envelopebalance"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entry",
+            name="unbalanced",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name="entry",
+            index=models.Index(
+                condition=models.Q(("unbalanced", True)),
+                fields=["user", "date"],
+                name="entry_unbalanced_idx",
+            ),
+        ),
+        migrations.RunPython(populate_unbalanced, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:10
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_entry_dates(apps, schema_editor):
+    Entry = apps.get_model("unclebudget", "Entry")
+    Item = apps.get_model("unclebudget", "Item")
+
+    Item.objects.update(
+        date=Subquery(Entry.objects.filter(pk=OuterRef("entry_id")).values("date"))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("unclebudget", "0012_entry_unbalanced"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="item",
+            options={"ordering": ["-date", "-amount"]},
+        ),
+        migrations.AddField(
+            model_name="item",
+            name="date",
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(copy_entry_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="item",
+            name="date",
+            field=models.DateField(editable=False),
+        ),
+    ]
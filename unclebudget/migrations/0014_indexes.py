@@ -0,0 +1,39 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("unclebudget", "0013_item_date"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="entry",
+            index=models.Index(
+                fields=["account", "date", "amount"], name="entry_account_date_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entry",
+            index=models.Index(
+                condition=models.Q(("expected", True)),
+                fields=["account", "date", "amount"],
+                name="entry_expected_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entry",
+            index=models.Index(fields=["user", "date"], name="entry_user_date_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                fields=["envelope", "date", "amount"], name="item_envelope_date_idx"
+            ),
+        ),
+    ]
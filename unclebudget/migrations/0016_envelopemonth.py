@@ -0,0 +1,103 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:58
+
+from collections import defaultdict
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_months(apps, schema_editor):
+    Item = apps.get_model("unclebudget", "Item")
+    EnvelopeMonth = apps.get_model("unclebudget", "EnvelopeMonth")
+
+    months = defaultdict(lambda: [0, 0, 0, 0])
+    for envelope_id, day, user_id, amount in Item.objects.values_list(
+        "envelope_id", "date", "user_id", "amount"
+    ):
+        if not amount:
+            continue
+        totals = months[(envelope_id, day.replace(day=1), user_id)]
+        # Income is negative, expenses positive
+        offset = 0 if amount < 0 else 2
+        totals[offset] += int((Decimal(amount) * 100).to_integral_value())
+        totals[offset + 1] += 1
+
+    EnvelopeMonth.objects.bulk_create(
+        [
+            EnvelopeMonth(
+                envelope_id=envelope_id,
+                month=month,
+                user_id=user_id,
+                income_cents=income_cents,
+                income_count=income_count,
+                expense_cents=expense_cents,
+                expense_count=expense_count,
+            )
+            for (envelope_id, month, user_id), (
+                income_cents,
+                income_count,
+                expense_cents,
+                expense_count,
+            ) in months.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("unclebudget", "0015_importjob"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EnvelopeMonth",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("month", models.DateField()),
+                ("income_cents", models.BigIntegerField(default=0)),
+                ("income_count", models.IntegerField(default=0)),
+                ("expense_cents", models.BigIntegerField(default=0)),
+                ("expense_count", models.IntegerField(default=0)),
+                (
+                    "envelope",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="unclebudget.envelope",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "month"], name="envelopemonth_user_idx"
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("envelope", "month"), name="envelopemonth_unique"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(populate_months, migrations.RunPython.noop),
+    ]
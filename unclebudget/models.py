@@ -1,10 +1,14 @@
 from datetime import date
 
 from django.contrib.auth.models import AnonymousUser, User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.urls import reverse
 
-from . import cache
+from . import cache, ledger
 from .exceptions import InsufficientFundsError
 
 
@@ -19,11 +23,7 @@ class Account(models.Model):
 
     @property
     def balance(self):
-        # We could calculate this in the DB, but sqlite3 doesn't have a
-        # decimal type, so do it here instead for accuracy
-        return -sum(
-            [entry.amount for entry in self.entry_set.all() if not entry.expected]
-        )
+        return ledger.account_balance(self)
 
     def get_absolute_url(self):
         return reverse("account-detail", kwargs={"pk": self.pk})
@@ -32,6 +32,44 @@ class Account(models.Model):
         return f"{self.name}"
 
 
+class AccountBalance(models.Model):
+    """Running balance of an account, kept up to date by the ledger"""
+
+    account = models.OneToOneField(
+        "Account", on_delete=models.CASCADE, primary_key=True
+    )
+    cents = models.BigIntegerField(default=0)
+
+
+class EntryManager(models.Manager):
+    def unbalanced_for(self, user):
+        return self.filter(user=user, unbalanced=True).order_by("date", "pk")
+
+    def refresh_unbalanced(self, pks, without_envelope=None):
+        """Recompute the unbalanced flag of many entries at once
+
+        Items in without_envelope aren't counted, for when it's being deleted.
+        """
+        items = ~Q(item__envelope=without_envelope) if without_envelope else None
+        unbalanced = {True: [], False: []}
+        for pk, cents, items_cents in (
+            self.filter(pk__in=pks)
+            .annotate(
+                entry_cents=ledger.cents("amount"),
+                items_cents=Coalesce(
+                    Sum(ledger.cents("item__amount"), filter=items), 0
+                ),
+            )
+            .order_by()
+            .values_list("pk", "entry_cents", "items_cents")
+        ):
+            unbalanced[cents != items_cents].append(pk)
+
+        for flag, flag_pks in unbalanced.items():
+            if flag_pks:
+                self.filter(pk__in=flag_pks).update(unbalanced=flag)
+
+
 class Entry(models.Model):
     amount = models.DecimalField(max_digits=9, decimal_places=2)
     date = models.DateField()
@@ -41,11 +79,35 @@ class Entry(models.Model):
     load = models.ForeignKey("Load", null=True, blank=True, on_delete=models.CASCADE)
 
     expected = models.BooleanField(default=False)
+    # Kept up to date as items change, so the process queue is one query
+    unbalanced = models.BooleanField(default=False)
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    objects = EntryManager()
+
     class Meta:
         ordering = ["-date", "-amount"]
+        indexes = [
+            # Account pages, and duplicate checks when loading
+            models.Index(
+                fields=["account", "date", "amount"], name="entry_account_date_idx"
+            ),
+            # Expected entries to match when loading
+            models.Index(
+                fields=["account", "date", "amount"],
+                condition=models.Q(expected=True),
+                name="entry_expected_idx",
+            ),
+            # Summary and reports
+            models.Index(fields=["user", "date"], name="entry_user_date_idx"),
+            # Process queue
+            models.Index(
+                fields=["user", "date"],
+                condition=models.Q(unbalanced=True),
+                name="entry_unbalanced_idx",
+            ),
+        ]
 
     @property
     def balance(self):
@@ -60,23 +122,27 @@ class Entry(models.Model):
     def get_absolute_url(self):
         return reverse("entry-detail", kwargs={"pk": self.pk})
 
-    def save(self, **kwargs):
-        super().save(**kwargs)
-
-        cache.clear_account_balance(self.account)
-
-        unbalanced = cache.get_unbalanced_entries(self.user)
+    def refresh_unbalanced(self):
+        self.unbalanced = not self.balanced
+        Entry.objects.filter(pk=self.pk).update(unbalanced=self.unbalanced)
 
-        if self.balanced:
-            if self in unbalanced:
-                unbalanced.remove(self)
-        else:
-            unbalanced.add(self)
+    def save(self, **kwargs):
+        # New entries can't have items yet
+        self.unbalanced = not self.balanced if self.pk else self.amount != 0
+
+        with transaction.atomic():
+            previous = Entry.objects.filter(pk=self.pk).first() if self.pk else None
+            super().save(**kwargs)
+            ledger.update_account_balances(
+                added=[self], removed=[previous] if previous else []
+            )
 
-        cache.set_unbalanced_entries(self.user, unbalanced)
+            if previous and previous.date != self.date:
+                ledger.redate_items(self.item_set.all())
 
-        for item in self.item_set.all():
-            cache.clear_item_date(item)
+        cache.clear_account_balance(self.account)
+        if previous and previous.account_id != self.account_id:
+            cache.clear_account_balance(previous.account)
 
     def __str__(self):
         return f"{self.account.name}: {self.date} ${self.amount} {self.description}"
@@ -94,46 +160,92 @@ class Envelope(models.Model):
 
     @property
     def balance(self):
-        # We could calculate this in the DB, but sqlite3 doesn't have a
-        # decimal type, so do it here instead for accuracy
-        return -sum([item.amount for item in self.item_set.all()])
+        return ledger.envelope_balance(self)
 
     def transfer_income_to(self, envelope, amount):
-        # Remember that income amounts are negative
-        transfer_items = []
-        remaining_amount = amount
-        for item in self.item_set.filter(amount__lt=0).order_by("-entry__date"):
-            transfer_items.append(item)
-            remaining_amount -= -item.amount
-
-            if remaining_amount <= 0:
-                break
-
-        # TODO We may not actually need to check for this--why couldn't
-        # a transfer create a new item and have the envelope balance go
-        # negative?
-        if remaining_amount > 0:
-            raise InsufficientFundsError(
-                "Envelope does not have enough income for transfer."
-            )
-
-        remaining_amount = amount
-        for item in transfer_items:
-            if -item.amount <= remaining_amount:
-                item.envelope = envelope
-                item.save()
+        self.transfer_income({envelope: amount})
+
+    def transfer_income(self, amounts):
+        """Move income from this envelope to others in one transaction
+
+        amounts maps each envelope to the amount it should get. The newest
+        income items are moved whole where they fit, and split otherwise.
+        Raises ValueError if any amount is negative.
+        """
+        if any(amount < 0 for amount in amounts.values()):
+            raise ValueError("Transfer amounts can't be negative")
+
+        amounts = {envelope: amount for envelope, amount in amounts.items() if amount}
+        total = sum(amounts.values())
+
+        with transaction.atomic():
+            # Remember that income amounts are negative
+            income = []
+            remaining_amount = total
+            for item in self.item_set.filter(amount__lt=0).order_by("-date"):
+                if remaining_amount <= 0:
+                    break
+                income.append(item)
                 remaining_amount -= -item.amount
 
-            else:
-                item.amount -= -remaining_amount
-                item.save()
-                Item.objects.create(
-                    amount=amount,
-                    description="",
-                    envelope=envelope,
-                    entry=item.entry,
-                    user=item.user,
+            # TODO We may not actually need to check for this--why couldn't
+            # a transfer create a new item and have the envelope balance go
+            # negative?
+            if remaining_amount > 0:
+                raise InsufficientFundsError(
+                    "Envelope does not have enough income for transfer."
+                )
+
+            targets = iter(amounts.items())
+            target, needed = next(targets, (None, 0))
+            previous, changed, created = [], [], []
+            for item in income:
+                available = -item.amount
+                portions = []
+                while available > 0 and target:
+                    portion = min(available, needed)
+                    portions.append((target, portion))
+                    available -= portion
+                    needed -= portion
+                    if needed <= 0:
+                        target, needed = next(targets, (None, 0))
+
+                previous.append(
+                    Item(
+                        amount=item.amount,
+                        date=item.date,
+                        envelope=self,
+                        user_id=item.user_id,
+                    )
                 )
+                if available:
+                    # Keep the rest of the item here
+                    item.amount = -available
+                else:
+                    # Move the item with its first portion
+                    (item.envelope, portion), *portions = portions
+                    item.amount = -portion
+                changed.append(item)
+
+                created += [
+                    Item(
+                        amount=-portion,
+                        date=item.date,
+                        description="",
+                        envelope=target,
+                        entry_id=item.entry_id,
+                        user_id=item.user_id,
+                    )
+                    for target, portion in portions
+                ]
+
+            Item.objects.bulk_update(changed, ["amount", "envelope"])
+            created = Item.objects.bulk_create(created)
+            ledger.update_envelope_balances(added=changed + created, removed=previous)
+
+        cache.clear_envelope_balance(self)
+        for envelope in amounts:
+            cache.clear_envelope_balance(envelope)
 
     def get_absolute_url(self):
         return reverse("envelope-detail", kwargs={"pk": self.pk})
@@ -142,43 +254,115 @@ class Envelope(models.Model):
         return f"{self.name}"
 
 
+class EnvelopeBalance(models.Model):
+    """Running balance of an envelope, kept up to date by the ledger"""
+
+    envelope = models.OneToOneField(
+        "Envelope", on_delete=models.CASCADE, primary_key=True
+    )
+    cents = models.BigIntegerField(default=0)
+
+
+class EnvelopeMonth(models.Model):
+    """Totals of an envelope's items in one month, kept up to date by the ledger
+
+    Expenses are items with positive amounts and income items with negative
+    ones, like in the reports. Totals are in cents, with the items' signs.
+    """
+
+    envelope = models.ForeignKey("Envelope", on_delete=models.CASCADE)
+    # The first day of the month
+    month = models.DateField()
+
+    income_cents = models.BigIntegerField(default=0)
+    income_count = models.IntegerField(default=0)
+    expense_cents = models.BigIntegerField(default=0)
+    expense_count = models.IntegerField(default=0)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["envelope", "month"], name="envelopemonth_unique"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["user", "month"], name="envelopemonth_user_idx"),
+        ]
+
+
+class ItemManager(models.Manager):
+    def create_many(self, items):
+        """Create items in bulk, like calling save() on each of them
+
+        Balances and unbalanced flags are updated once for the whole batch,
+        and each envelope's cached balance is cleared once.
+        """
+        for item in items:
+            item.match_entry()
+
+        with transaction.atomic():
+            items = self.bulk_create(items)
+            ledger.update_envelope_balances(added=items)
+            Entry.objects.refresh_unbalanced({item.entry_id for item in items})
+
+        for envelope_id in {item.envelope_id for item in items}:
+            cache.clear_envelope_balance(Envelope(pk=envelope_id))
+
+        return items
+
+
 class Item(models.Model):
     amount = models.DecimalField(max_digits=9, decimal_places=2)
     description = models.TextField()
 
+    # Copy of entry.date, so items can be filtered and sorted by date
+    # without joining entries. match_entry sets it, so forms leave it out.
+    date = models.DateField(editable=False)
+
     envelope = models.ForeignKey("Envelope", on_delete=models.CASCADE)
     entry = models.ForeignKey("Entry", on_delete=models.CASCADE)
     tags = models.ManyToManyField("Tag")
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
-    class Meta:
-        ordering = ["-entry__date", "-amount"]
+    objects = ItemManager()
 
-    def save(self, **kwargs):
+    class Meta:
+        ordering = ["-date", "-amount"]
+        indexes = [
+            # Envelope pages and stats
+            models.Index(
+                fields=["envelope", "date", "amount"], name="item_envelope_date_idx"
+            ),
+        ]
+
+    def match_entry(self):
         # Item amount signs always match their entries
         if (self.entry.amount > 0 and self.amount < 0) or (
             self.entry.amount < 0 and self.amount > 0
         ):
             self.amount *= -1
 
-        for item in self.entry.item_set.all():
-            if item == self:
-                continue
-
-        super().save(**kwargs)
-
-        cache.clear_envelope_balance(self.envelope)
+        self.date = self.entry.date
 
-        unbalanced = cache.get_unbalanced_entries(self.user)
+    def save(self, **kwargs):
+        self.match_entry()
 
-        if self.entry.balanced:
-            if self.entry in unbalanced:
-                unbalanced.remove(self.entry)
-        else:
-            unbalanced.add(self.entry)
+        with transaction.atomic():
+            previous = Item.objects.filter(pk=self.pk).first() if self.pk else None
+            super().save(**kwargs)
+            ledger.update_envelope_balances(
+                added=[self], removed=[previous] if previous else []
+            )
+            self.entry.refresh_unbalanced()
+            if previous and previous.entry_id != self.entry_id:
+                previous.entry.refresh_unbalanced()
 
-        cache.set_unbalanced_entries(self.user, unbalanced)
+        cache.clear_envelope_balance(self.envelope)
+        if previous and previous.envelope_id != self.envelope_id:
+            cache.clear_envelope_balance(previous.envelope)
 
     def __str__(self):
         return (
@@ -197,14 +381,97 @@ class Load(models.Model):
         ordering = ["-timestamp"]
 
     def delete(self, *args, **kwargs):
-        for entry in self.entry_set.all():
-            entry.delete()
-        super().delete(*args, **kwargs)
+        """Delete the load, its entries and their items with set-based deletes
+
+        Returns the number of rows deleted and a dict of counts per model,
+        like QuerySet.delete().
+        """
+        entries = self.entry_set.all()
+        items = Item.objects.filter(entry__in=entries)
+
+        with transaction.atomic():
+            accounts, envelopes = ledger.remove_entries(entries)
+
+            # Raw deletes skip the collector, which would load every row and
+            # send a post_delete for each; the ledger is already updated
+            counts = {
+                Item.tags.through._meta.label: Item.tags.through.objects.filter(
+                    item__in=items
+                ).delete()[0],
+                Item._meta.label: items._raw_delete(items.db),
+                Entry._meta.label: entries._raw_delete(entries.db),
+            }
+            _, load_counts = super().delete(*args, **kwargs)
+
+        for pk in accounts:
+            cache.clear_account_balance(Account(pk=pk))
+        for pk in envelopes:
+            cache.clear_envelope_balance(Envelope(pk=pk))
+
+        counts.update(load_counts)
+        return sum(counts.values()), {
+            label: count for label, count in counts.items() if count
+        }
 
     def __str__(self):
         return f"{self.loader}: {self.entry_set.first().account} {self.timestamp}"
 
 
+class ImportJob(models.Model):
+    """An uploaded CSV waiting for, or going through, the loader"""
+
+    class Status(models.TextChoices):
+        QUEUED = "queued"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    account = models.ForeignKey("Account", on_delete=models.CASCADE)
+    # The uploaded file, streamed to MEDIA_ROOT so the upload isn't held in
+    # memory. Deleted once loaded, since the load keeps its own copy.
+    csv = models.FileField(upload_to="imports/", blank=True)
+    load = models.ForeignKey("Load", null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.TextField(choices=Status, default=Status.QUEUED)
+    error = models.TextField(blank=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    # Progress, updated as each chunk is committed
+    rows = models.PositiveIntegerField(default=0)
+    matched = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    # Set when the job is claimed and as each chunk is committed, so a running
+    # job that's gone quiet can be told from a slow one
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    # How long the loader took, once it's done
+    seconds = models.FloatField(null=True, blank=True)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        ordering = ["-timestamp"]
+        indexes = [
+            models.Index(
+                fields=["timestamp"],
+                condition=models.Q(status="queued"),
+                name="importjob_queued_idx",
+            ),
+        ]
+
+    @property
+    def finished(self):
+        return self.status in (self.Status.DONE, self.Status.FAILED)
+
+    @property
+    def rows_per_second(self):
+        if self.seconds:
+            return self.rows / self.seconds
+        return None
+
+    def get_absolute_url(self):
+        return reverse("import-job", kwargs={"pk": self.pk})
+
+
 class Note(models.Model):
     text = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
@@ -221,14 +488,25 @@ class Template(models.Model):
     name = models.TextField()
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
-    def apply_to(self, entry):
-        for item in self.templateitem_set.all():
-            Item.objects.create(
-                amount=item.amount,
-                envelope=item.envelope,
-                entry=entry,
-                user=self.user,
-            )
+    def build_items(self, entries):
+        """Unsaved items that applying the template to entries would create"""
+        template_items = list(self.templateitem_set.select_related("envelope"))
+        items = []
+        for entry in entries:
+            for template_item in template_items:
+                item = Item(
+                    amount=template_item.amount,
+                    description="",
+                    envelope=template_item.envelope,
+                    entry=entry,
+                    user=self.user,
+                )
+                item.match_entry()
+                items.append(item)
+        return items
+
+    def apply_to(self, *entries):
+        return Item.objects.create_many(self.build_items(entries))
 
     def __str__(self):
         return self.name
@@ -283,3 +561,19 @@ class UserData(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
     objects = UserDataManager()
+
+    def save(self, **kwargs):
+        super().save(**kwargs)
+        cache.clear_user_data(self.user)
+
+
+@receiver(post_delete, sender=ImportJob)
+def import_job_deleted(sender, instance, **kwargs):
+    if instance.csv:
+        instance.csv.delete(save=False)
+
+
+@receiver(post_delete, sender=Envelope)
+def envelope_deleted(sender, instance, **kwargs):
+    # The user's cached UserData may point to the envelope
+    cache.clear_user_data(User(pk=instance.user_id))
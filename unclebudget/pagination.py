@@ -0,0 +1,68 @@
+from datetime import date
+from decimal import Decimal
+
+from django.core import signing
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+PAGE_SIZE = 100
+
+SALT = "unclebudget.pagination"
+
+
+def cursor_after(row_date, row):
+    """Cursor for the page after row"""
+    return signing.dumps(
+        {"date": row_date.isoformat(), "amount": str(row.amount), "pk": row.pk},
+        salt=SALT,
+    )
+
+
+def keyset_page(queryset, cursor, date_field="date", size=None):
+    """Get a page of queryset, ordered newest first by (date, amount, pk)
+
+    cursor comes from cursor_after on the last row of the previous page, or is
+    None for the first page. Returns the rows, whether there are more, and the
+    decoded cursor (None for the first page), for rows_before.
+    """
+    queryset, size, state = _page(queryset, cursor, date_field, size)
+    rows = list(queryset[: size + 1])
+    return rows[:size], len(rows) > size, state
+
+
+async def akeyset_page(queryset, cursor, date_field="date", size=None):
+    """Async version of keyset_page"""
+    queryset, size, state = _page(queryset, cursor, date_field, size)
+    rows = [row async for row in queryset[: size + 1]]
+    return rows[:size], len(rows) > size, state
+
+
+def _page(queryset, cursor, date_field, size):
+    size = size or PAGE_SIZE
+    queryset = queryset.order_by(f"-{date_field}", "-amount", "-pk")
+
+    state = None
+    if cursor:
+        try:
+            state = signing.loads(cursor, salt=SALT)
+        except signing.BadSignature:
+            raise BadRequest("Invalid page")
+
+        queryset = queryset.filter(_after(state, date_field))
+
+    return queryset, size, state
+
+
+def rows_before(queryset, state, date_field="date"):
+    """The rows of queryset on the pages before the decoded cursor state"""
+    return queryset.exclude(_after(state, date_field))
+
+
+def _after(state, date_field):
+    after_date = date.fromisoformat(state["date"])
+    after_amount = Decimal(state["amount"])
+    return (
+        Q(**{f"{date_field}__lt": after_date})
+        | Q(**{date_field: after_date, "amount__lt": after_amount})
+        | Q(**{date_field: after_date, "amount": after_amount, "pk__lt": state["pk"]})
+    )
@@ -0,0 +1,24 @@
+class CacheRouter:
+    """Keep the database cache's table in the cache database, and nothing else
+
+    createcachetable and DatabaseCache both ask the router where the table
+    goes, through a model in the django_cache app.
+    """
+
+    app_label = "django_cache"
+    database = "cache"
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return self.database
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_migrate(self, db, app_label, **hints):
+        if app_label == self.app_label:
+            return db == self.database
+        if db == self.database:
+            return False
+        return None
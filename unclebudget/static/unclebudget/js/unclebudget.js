@@ -44,3 +44,29 @@ function quickAdvanceChange(element) {
     localStorage.setItem("quick-advance", "");
   }
 }
+
+function pollImportJob() {
+  const job = document.getElementById("import-job");
+  if (!job || job.dataset.finished === "true") {
+    return;
+  }
+
+  const interval = setInterval(async () => {
+    const response = await fetch(job.dataset.progressUrl);
+    if (!response.ok) {
+      return;
+    }
+
+    const progress = await response.json();
+    for (const element of job.querySelectorAll("[data-field]")) {
+      element.textContent = progress[element.dataset.field];
+    }
+
+    // Reload to show the loaded entries
+    if (progress.finished) {
+      clearInterval(interval);
+      location.reload();
+    }
+  }, 1000);
+}
+window.addEventListener("load", pollImportJob);
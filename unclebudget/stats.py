@@ -1,8 +1,11 @@
-from datetime import date, datetime, timedelta
+from array import array
+from datetime import date, datetime
 
-from . import cache
+from . import cache, ledger
 from .models import *
 
+ROLLING_WINDOWS = (3, 6, 12)
+
 
 # cmonth (continuous month) = year*12 + month
 def date_to_cmonth(date):
@@ -10,119 +13,119 @@ def date_to_cmonth(date):
 
 
 def cmonth_to_date(cmonth):
-    return date(cmonth // 12, cmont % 12, 1)
-
-
-def items_by_cmonth(envelope):
-    beginning_of_time = UserData.objects.for_user(envelope.user).beginning_of_time
-
-    cmonths = {
-        cmonth: []
-        for cmonth in range(
-            date_to_cmonth(beginning_of_time), date_to_cmonth(datetime.now())
+    return date((cmonth - 1) // 12, (cmonth - 1) % 12 + 1, 1)
+
+
+def expense_columns(user, start_cmonth, end_cmonth):
+    """Fetch the monthly expenses of user from start_cmonth up to end_cmonth
+
+    Returns columns of envelope ids, cmonths, and totals in cents, read from
+    the monthly envelope totals. Expenses are items with positive amounts,
+    like in the expenses report.
+    """
+    envelope_ids = array("q")
+    cmonths = array("q")
+    amounts = array("q")
+
+    rows = (
+        EnvelopeMonth.objects.filter(
+            user=user,
+            expense_count__gt=0,
+            month__gte=cmonth_to_date(start_cmonth),
+            month__lt=cmonth_to_date(end_cmonth),
         )
+        .order_by()
+        .values_list("envelope_id", "month", "expense_cents")
+    )
+    for envelope_id, month, cents in rows.iterator():
+        envelope_ids.append(envelope_id)
+        cmonths.append(date_to_cmonth(month))
+        amounts.append(cents)
+
+    return envelope_ids, cmonths, amounts
+
+
+def monthly_expenses(user):
+    """Total expenses of each envelope for each month
+
+    Months run from the beginning of time up to, but not including, the
+    current month. Returns the first cmonth and a dict of envelope ids to
+    arrays of monthly totals in cents.
+    """
+    start_cmonth = date_to_cmonth(cache.get_user_data(user).beginning_of_time)
+    end_cmonth = date_to_cmonth(datetime.now())
+    months = max(end_cmonth - start_cmonth, 0)
+
+    totals = {
+        pk: array("q", [0]) * months
+        for pk in Envelope.objects.filter(user=user).values_list("pk", flat=True)
     }
 
-    for item in envelope.item_set.all():
-        cmonth = date_to_cmonth(cache.get_item_date(item))
-
-        # if this is false, cmonth is current month or before beginning of time
-        if cmonth in cmonths:
-            cmonths[cmonth].append(item)
-
-    return cmonths
-
+    for envelope_id, cmonth, cents in zip(
+        *expense_columns(user, start_cmonth, end_cmonth)
+    ):
+        totals[envelope_id][cmonth - start_cmonth] += cents
 
-def month_diff(date1, date2):
-    years = abs(date1.year - date2.year)
-    months = abs(date1.month - date2.month)
-    return years * 12 + months
+    return start_cmonth, totals
 
 
-def months_back(d, count):
-    d -= timedelta(days=1)
-    d = date(d.year, d.month, 1)
+def rolling_expenses(monthly, window):
+    """Sum of each month and the window - 1 months before it, in cents"""
+    rolling = array("q", [0]) * len(monthly)
 
-    if count > 1:
-        return months_back(d, count - 1)
-    return d
+    total = 0
+    for i, cents in enumerate(monthly):
+        total += cents
+        if i >= window:
+            total -= monthly[i - window]
+        rolling[i] = total
 
+    return rolling
 
-def expenses(items):
-    return [item.amount for item in items if item.amount < 0]
 
-
-def envelope_mean_expenses(user):
-    envelopes = Envelope.objects.filter(user=user)
-
-    envelope_ranges = {}
-
-    for envelope in envelopes:
-        expenses_by_cmonth = {
-            cmonth: sum(expenses(items))
-            for cmonth, items in items_by_cmonth(envelope).items()
-        }
-
-        latest_cmonth = max(expenses_by_cmonth.keys())
-        i = 1
-        while True:
-            for cmonth in range(latest_cmonth + 1 - i, latest_cmonth + 1):
-                pass
+def mean_expenses(monthly):
+    """Mean monthly expenses since the first month with any, in cents"""
+    for first, cents in enumerate(monthly):
+        if cents:
+            return sum(monthly[first:]) / (len(monthly) - first)
+    return 0
 
 
 def envelope_monthly_expenses(user):
+    start_cmonth, totals = monthly_expenses(user)
     return {
         envelope: {
-            cmonth: sum(expenses(items))
-            for cmonth, items in items_by_cmonth(envelope).items()
+            start_cmonth + i: ledger.from_cents(cents)
+            for i, cents in enumerate(totals[envelope.pk])
         }
         for envelope in Envelope.objects.filter(user=user)
     }
 
 
-"""
-def stats(user):
-    stats = {}
-
-    now = datetime.now().date()
-    current_month = date(now.year, now.month, 1)
-    three_months_back = months_back(current_month, 3)
-    six_months_back = months_back(current_month, 6)
-
-    beginning_of_time = UserData.objects.for_user(user).beginning_of_time
-    first_date = now
-
-    envelopes = Envelope.objects.filter(user=user)
-
-    for envelope in envelopes:
-        if envelope.name != "Rent":
-            continue
-
-        stats[envelope] = {}
+def envelope_mean_expenses(user):
+    _, totals = monthly_expenses(user)
+    return {
+        envelope: ledger.from_cents(round(mean_expenses(totals[envelope.pk])))
+        for envelope in Envelope.objects.filter(user=user)
+    }
 
-        all_time_items = []
-        three_month_items = []
-        six_month_items = []
-        for item in envelope.item_set.all():
-            item_date = cache.get_item_date(item)
 
-            if item_date >= current_month or item_date < beginning_of_time:
-                continue
+def stats(user):
+    """Mean monthly expenses of each envelope
 
-            if item_date < first_date:
-                first_date = item_date
+    Keyed by window size in months, with 0 for all time. Only complete months
+    are counted.
+    """
+    _, totals = monthly_expenses(user)
 
-            if item_date > three_months_back:
-                three_month_items.append(item)
-            if item_date > six_months_back:
-                six_month_items.append(item)
-            all_time_items.append(item)
+    stats = {}
+    for envelope in Envelope.objects.filter(user=user):
+        monthly = totals[envelope.pk]
 
-        stats[envelope][0] = expenses(all_time_items) / (
-            month_diff(now, first_date) + 1
-        )
-        stats[envelope][3] = expenses(three_month_items) / 3
-        stats[envelope][6] = expenses(six_month_items) / 6
+        stats[envelope] = {0: ledger.from_cents(round(mean_expenses(monthly)))}
+        for window in ROLLING_WINDOWS:
+            rolling = rolling_expenses(monthly, window)
+            cents = rolling[-1] / window if rolling else 0
+            stats[envelope][window] = ledger.from_cents(round(cents))
 
     return stats
-"""
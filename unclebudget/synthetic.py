@@ -0,0 +1,212 @@
+"""Deterministic synthetic ledgers, for benchmarking with realistic data"""
+
+from datetime import date, timedelta
+from decimal import Decimal
+from random import Random
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import ledger
+from .models import *
+
+# Share of entries that are income, split across several envelopes, expected
+# but not yet loaded, or not yet processed (unbalanced)
+INCOME_RATIO = 0.08
+SPLIT_RATIO = 0.15
+EXPECTED_RATIO = 0.02
+UNBALANCED_RATIO = 0.05
+
+ENVELOPE_NAMES = [
+    "Groceries",
+    "Rent",
+    "Utilities",
+    "Transportation",
+    "Dining",
+    "Medical",
+    "Entertainment",
+    "Clothing",
+    "Gifts",
+    "Travel",
+    "Household",
+    "Subscriptions",
+]
+
+DESCRIPTIONS = [
+    "GROCERY OUTLET",
+    "CITY UTILITIES",
+    "GAS STATION",
+    "COFFEE SHOP",
+    "PHARMACY",
+    "HARDWARE STORE",
+    "ONLINE MARKETPLACE",
+    "RESTAURANT",
+    "STREAMING SERVICE",
+    "BOOKSTORE",
+]
+
+# Header and date format of loaders.second, which the benchmark loads
+CSV_HEADER = "Transaction Date,Post Date,Transaction Detail,Amount"
+CSV_DATE_FORMAT = "%Y-%m-%d"
+
+
+def generate(
+    users=1,
+    accounts=3,
+    envelopes=12,
+    entries=10000,
+    days=3 * 365,
+    end=date(2025, 12, 31),
+    seed=0,
+    prefix="synthetic",
+):
+    """Create users with accounts, envelopes, a template and entries
+
+    Each user gets the given number of accounts, envelopes and entries, with
+    entries spread over the days up to end. The same arguments always create
+    the same ledger. Returns the new users.
+    """
+    random = Random(seed)
+    start = end - timedelta(days=days - 1)
+
+    created = []
+    with transaction.atomic():
+        for n in range(users):
+            user = User.objects.create_user(f"{prefix}{n}")
+            _generate_user(random, user, accounts, envelopes, entries, start, days)
+            created.append(user)
+    return created
+
+
+def _generate_user(random, user, accounts, envelopes, entries, start, days):
+    accounts = Account.objects.bulk_create(
+        Account(name=f"Account {n + 1}", start_date=start, user=user)
+        for n in range(accounts)
+    )
+
+    income = Envelope.objects.create(name="Income", user=user)
+    small_change = Envelope.objects.create(name="Small change", user=user)
+    envelopes = Envelope.objects.bulk_create(
+        Envelope(
+            name=(
+                ENVELOPE_NAMES[n] if n < len(ENVELOPE_NAMES) else f"Envelope {n + 1}"
+            ),
+            pinned=n < 3,
+            user=user,
+        )
+        for n in range(max(envelopes - 2, 1))
+    )
+
+    UserData.objects.create(
+        beginning_of_time=start.replace(day=1),
+        small_change_envelope=small_change,
+        user=user,
+    )
+
+    template = Template.objects.create(name="Split", user=user)
+    TemplateItem.objects.bulk_create(
+        TemplateItem(envelope=envelope, amount=amount, template=template)
+        for envelope, amount in zip(envelopes, (Decimal("20.00"), Decimal("5.00")))
+    )
+
+    new_entries = []
+    split_by_entry = []
+    for n in range(entries):
+        account = random.choice(accounts)
+        entry_date = start + timedelta(days=random.randrange(days))
+        roll = random.random()
+
+        if roll < INCOME_RATIO:
+            amount = -Decimal(random.randrange(150000, 400000)) / 100
+            description = "PAYROLL DEPOSIT"
+            splits = [(income, amount)]
+        else:
+            amount = Decimal(random.randrange(50, 25000)) / 100
+            description = random.choice(DESCRIPTIONS)
+            splits = [(random.choice(envelopes), amount)]
+            if roll < INCOME_RATIO + SPLIT_RATIO and amount >= 1:
+                # Two or three envelopes, with the remainder in the last
+                envelopes_split = random.sample(envelopes, min(3, len(envelopes)))
+                splits = []
+                remaining = amount
+                for envelope in envelopes_split[: random.randint(1, 2)]:
+                    part = (remaining * Decimal(random.randint(20, 60)) / 100).quantize(
+                        Decimal("0.01")
+                    )
+                    splits.append((envelope, part))
+                    remaining -= part
+                splits.append((envelopes_split[-1], remaining))
+
+        roll = random.random()
+        expected = roll < EXPECTED_RATIO
+        if expected or roll < EXPECTED_RATIO + UNBALANCED_RATIO:
+            splits = []
+
+        new_entries.append(
+            Entry(
+                account=account,
+                amount=amount,
+                date=entry_date,
+                description=f"{description} {n % 997}",
+                expected=expected,
+                unbalanced=not splits,
+                user=user,
+            )
+        )
+        split_by_entry.append(splits)
+
+    # One load per account per month, like monthly uploads. Expected entries
+    # haven't been loaded yet.
+    months = sorted(
+        {
+            (entry.account_id, entry.date.year, entry.date.month)
+            for entry in new_entries
+            if not entry.expected
+        }
+    )
+    loads = dict(
+        zip(
+            months,
+            Load.objects.bulk_create(
+                Load(loader="synthetic", text="", user=user) for _ in months
+            ),
+        )
+    )
+    for entry in new_entries:
+        if not entry.expected:
+            entry.load = loads[(entry.account_id, entry.date.year, entry.date.month)]
+
+    new_entries = Entry.objects.bulk_create(new_entries, batch_size=1000)
+
+    items = [
+        Item(
+            amount=amount,
+            date=entry.date,
+            description="",
+            envelope=envelope,
+            entry=entry,
+            user=user,
+        )
+        for entry, splits in zip(new_entries, split_by_entry)
+        for envelope, amount in splits
+    ]
+    items = Item.objects.bulk_create(items, batch_size=1000)
+
+    ledger.update_account_balances(added=new_entries)
+    ledger.update_envelope_balances(added=items)
+
+
+def csv(rows, end=date(2025, 12, 31), seed=0):
+    """Text of a CSV with rows charges in the loaders.second format"""
+    random = Random(seed)
+    lines = [CSV_HEADER]
+    for n in range(rows):
+        charge_date = end - timedelta(days=random.randrange(365))
+        amount = Decimal(random.randrange(50, 25000)) / 100
+        lines.append(
+            f"{charge_date.strftime(CSV_DATE_FORMAT)},"
+            f"{charge_date.strftime(CSV_DATE_FORMAT)},"
+            f"{random.choice(DESCRIPTIONS)} {seed}-{n},"
+            f"{amount}"
+        )
+    return "\n".join(lines) + "\n"
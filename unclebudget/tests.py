@@ -1,18 +1,45 @@
+from array import array
+from contextlib import ExitStack
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from io import StringIO
+from tempfile import TemporaryDirectory
+from time import time
+from unittest.mock import patch
 
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from . import cache, stats
-from .loader import load_entries
+from . import benchmark, cache, imports, ledger, metrics, stats, synthetic
+from .cache_backends import LayeredCache
+from .exceptions import InsufficientFundsError
+from .loader import LoadException, load_entries, register_loaders
 from .models import *
 
 
 class LoaderTestCase(TestCase):
+    databases = {"default", "cache"}
+
     def setUp(self):
+        # The local cache layer isn't rolled back between tests
+        caches["default"].clear()
+
+        # Queued uploads are saved as files
+        media_root = self.enterContext(TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
         User.objects.create_user("testuser", "testuser@example.com", "password").save()
         self.user = User.objects.get()
         self.client.login(username="testuser", password="password")
@@ -71,6 +98,8 @@ class LoaderTestCase(TestCase):
 
         _, entries = load_entries(self.account, csv)
         self.assertEqual(len(Entry.objects.all()), 3)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
 
     def test_small_change(self):
         envelope = Envelope.objects.create(
@@ -94,6 +123,9 @@ class LoaderTestCase(TestCase):
 
         self.assertEqual(envelope.item_set.count(), 1)
         self.assertEqual(envelope.item_set.first().amount, Decimal("0.51"))
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+        self.assertEqual(Entry.objects.unbalanced_for(self.user).count(), 2)
 
     def test_small_change_abs(self):
         envelope = Envelope.objects.create(
@@ -128,9 +160,183 @@ class LoaderTestCase(TestCase):
         _, entries = load_entries(self.account, csv)
         self.assertEqual(len(Entry.objects.all()), 4)
 
+    def test_unknown_columns(self):
+        csv = """Posted,Memo,Debit
+01/11/2021,PAYFRIEND,30"""
+        with self.assertRaises(LoadException):
+            load_entries(self.account, csv)
+        self.assertEqual(Load.objects.count(), 0)
+
+    def test_conflicting_loaders(self):
+        with self.settings(UNCLEBUDGET_LOADERS=["loaders.first", "loaders.first"]):
+            with self.assertRaises(ImproperlyConfigured):
+                register_loaders()
+        register_loaders()
+
+    def test_load_in_chunks(self):
+        csv = """Transaction Date,Post Date,Transaction Detail,Amount
+2021-01-20,2021-01-20,SUPER SUSHI,10.10
+2021-01-19,2021-01-20,WAYOUT,300.20
+2021-01-19,2021-01-20,ZAXDEE,8.30
+2021-01-22,2021-01-22,GROVERS GROCERY,35.50
+2021-02-04,2021-02-04,PAYMENT,-354.10"""
+        with patch("unclebudget.loader.CHUNK_SIZE", 2):
+            load, entries = load_entries(self.account, csv)
+
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(load.text, csv)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    @override_settings(UNCLEBUDGET_IMPORT_MODE="inline")
+    def test_upload(self):
+        csv = b"""\xef\xbb\xbf"Date","Description","Amount"
+01/11/2021,"PAYFRIEND",-30
+01/10/2021,"MICKEY KING",-4.51"""
+        self.client.login(username="testuser", password="password")
+        response = self.client.post(
+            reverse("upload"),
+            {
+                "account": self.account.id,
+                "csv": SimpleUploadedFile("export.csv", csv),
+            },
+            follow=True,
+        )
+        self.assertEqual(len(response.context["entries"]), 2)
+        self.assertEqual(Entry.objects.count(), 2)
+        self.assertContains(response, "rows/sec")
+
+        job = response.context["job"]
+        response = self.client.get(reverse("import-job-progress", args=[job.pk]))
+        progress = response.json()
+        self.assertGreater(progress.pop("seconds"), 0)
+        self.assertEqual(
+            progress,
+            {
+                "status": "done",
+                "finished": True,
+                "rows": 2,
+                "matched": 0,
+                "inserted": 2,
+                "duplicates": 0,
+                "error": "",
+            },
+        )
+
+    @override_settings(UNCLEBUDGET_IMPORT_MODE="worker")
+    def test_import_queue(self):
+        csv = """Transaction Date,Post Date,Transaction Detail,Amount
+2021-01-20,2021-01-20,SUPER SUSHI,10.10
+2021-01-19,2021-01-20,WAYOUT,300.20
+2021-01-19,2021-01-20,ZAXDEE,8.30"""
+        job = imports.enqueue(self.account, csv)
+        bad_job = imports.enqueue(self.account, "Posted,Memo\n01/11/2021,PAYFRIEND")
+        self.assertEqual(job.status, ImportJob.Status.QUEUED)
+        self.assertEqual(Entry.objects.count(), 0)
+        self.assertTrue(default_storage.exists(job.csv.name))
+        csv_name = job.csv.name
+        bad_csv_name = bad_job.csv.name
+
+        with patch("unclebudget.loader.CHUNK_SIZE", 2):
+            call_command("runimports", once=True, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.DONE)
+        self.assertEqual((job.rows, job.inserted, job.duplicates), (3, 3, 0))
+        self.assertEqual(job.load.entry_set.count(), 3)
+        self.assertEqual(job.csv, "")
+        self.assertFalse(default_storage.exists(csv_name))
+
+        bad_job.refresh_from_db()
+        self.assertEqual(bad_job.status, ImportJob.Status.FAILED)
+        self.assertIn("No loader", bad_job.error)
+        self.assertEqual(bad_job.csv, "")
+        self.assertFalse(default_storage.exists(bad_csv_name))
+
+        # Nothing new, so no load is kept
+        job = imports.enqueue(self.account, csv)
+        self.assertEqual(imports.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.rows, job.inserted, job.duplicates), (3, 0, 3))
+        self.assertIsNone(job.load)
+        self.assertEqual(Load.objects.count(), 1)
+
+    @override_settings(UNCLEBUDGET_IMPORT_MODE="worker")
+    def test_requeue_stale_imports(self):
+        csv = """Transaction Date,Post Date,Transaction Detail,Amount
+2021-01-20,2021-01-20,SUPER SUSHI,10.10"""
+        stopped = imports.enqueue(self.account, csv)
+        partial = imports.enqueue(self.account, csv)
+        running = imports.enqueue(self.account, csv)
+        load = Load.objects.create(loader="loaders.second", user=self.user)
+
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        ImportJob.objects.update(status=ImportJob.Status.RUNNING)
+        ImportJob.objects.exclude(pk=running.pk).update(heartbeat=an_hour_ago)
+        ImportJob.objects.filter(pk=partial.pk).update(load=load)
+        ImportJob.objects.filter(pk=running.pk).update(heartbeat=timezone.now())
+        partial_csv_name = partial.csv.name
+
+        # Polling a stopped job recovers it
+        response = self.client.get(reverse("import-job-progress", args=[stopped.pk]))
+        self.assertEqual(response.json()["status"], "queued")
+
+        partial.refresh_from_db()
+        self.assertEqual(partial.status, ImportJob.Status.FAILED)
+        self.assertIn("interrupted", partial.error)
+        self.assertEqual(partial.load, load)
+        self.assertEqual(partial.csv, "")
+        self.assertFalse(default_storage.exists(partial_csv_name))
+        running.refresh_from_db()
+        self.assertEqual(running.status, ImportJob.Status.RUNNING)
+
+        self.assertEqual(imports.run_pending(), 1)
+        stopped.refresh_from_db()
+        self.assertEqual(stopped.status, ImportJob.Status.DONE)
+
+    def test_import_fails_midway(self):
+        Entry.objects.create(
+            account=self.account,
+            amount=Decimal("8.30"),
+            date=date(2021, 2, 1),
+            description="ZAXDEE expected",
+            expected=True,
+            user=self.user,
+        )
+        csv = """Transaction Date,Post Date,Transaction Detail,Amount
+2021-01-20,2021-01-20,SUPER SUSHI,10.10
+2021-01-19,2021-01-20,ZAXDEE,8.30
+2021-01-19,2021-01-20,WAYOUT,300.20
+not a date,2021-01-20,BROKEN,1.00"""
+        job = imports.enqueue(self.account, csv)
+
+        # The first chunk is committed before the bad row is read
+        with patch("unclebudget.loader.CHUNK_SIZE", 2):
+            with self.assertLogs("unclebudget.imports", "ERROR"):
+                imports.run_pending()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertIsNone(job.load)
+        self.assertFalse(Load.objects.exists())
+
+        # Only the expected entry is left, as it was
+        entry = Entry.objects.get()
+        self.assertTrue(entry.expected)
+        self.assertEqual(entry.date, date(2021, 2, 1))
+        self.assertEqual(entry.description, "ZAXDEE expected")
+        self.assertEqual(cache.get_account_balance(self.account), 0)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
 
 class ModelsTestCase(TestCase):
+    databases = {"default", "cache"}
+
     def setUp(self):
+        # The local cache layer isn't rolled back between tests
+        caches["default"].clear()
+
         User.objects.create_user("testuser", "testuser@example.com", "password").save()
         self.user = User.objects.get()
         self.client.login(username="testuser", password="password")
@@ -265,6 +471,70 @@ class ModelsTestCase(TestCase):
         response = self.client.get(reverse("envelope-detail", kwargs={"pk": 1}))
         self.assertEqual(response.status_code, 404)
 
+    async def test_async_views(self):
+        await self.async_client.aforce_login(self.user)
+        for url in (
+            reverse("summary"),
+            reverse("all"),
+            reverse("account-detail", kwargs={"pk": self.account.pk}),
+            reverse("envelope-detail", kwargs={"pk": self.envelope.pk}),
+            reverse("report-expenses-by-month"),
+            reverse("report-income"),
+        ):
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+        response = await self.async_client.get(reverse("all"))
+        self.assertEqual(response.context["to_process"], 0)
+        self.assertEqual(response.context["accounts_balance"], Decimal("902.92"))
+
+    def test_metrics(self):
+        metrics.registry.clear()
+        self.client.get(reverse("summary"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("upload"))
+        # Later requests reset the query log
+        upload_queries = len(queries)
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 404)
+
+        with self.settings(UNCLEBUDGET_METRICS_TOKEN="secret"):
+            response = self.client.get(
+                reverse("metrics"), headers={"Authorization": "Bearer secret"}
+            )
+        text = response.content.decode()
+        self.assertIn('unclebudget_request_seconds_count{view="summary"} 1\n', text)
+        self.assertIn(
+            f'unclebudget_db_queries_total{{view="upload"}} {upload_queries}\n', text
+        )
+        self.assertIn(
+            'unclebudget_cache_requests_total{family="envelope:balance",result=', text
+        )
+
+    def test_cache_database(self):
+        self.assertIn("cache", connections["cache"].introspection.table_names())
+        self.assertNotIn("cache", connection.introspection.table_names())
+        self.assertNotIn(
+            "unclebudget_entry", connections["cache"].introspection.table_names()
+        )
+
+    def test_database_cache_set_many(self):
+        shared = caches["shared"]
+        shared.set("a", 1)
+        with CaptureQueriesContext(connections["cache"]) as queries:
+            self.assertEqual(shared.set_many({"a": 2, "b": Decimal("3.50")}), [])
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(shared.get_many(["a", "b"]), {"a": 2, "b": Decimal("3.50")})
+
+    def test_sqlite_pragmas(self):
+        with connection.cursor() as cursor:
+            for pragma in ("busy_timeout", "cache_size"):
+                cursor.execute(f"PRAGMA {pragma}")
+                self.assertEqual(
+                    cursor.fetchone()[0], int(settings.SQLITE_PRAGMAS[pragma])
+                )
+
     def test_dark_mode_toggle(self):
         response = self.client.get("/")
         self.assertIn('data-bs-theme="dark"', response.content.decode())
@@ -272,6 +542,29 @@ class ModelsTestCase(TestCase):
         response = self.client.get("/")
         self.assertNotIn('data-bs-theme="dark"', response.content.decode())
 
+        # A change the cached copy hasn't seen yet isn't overwritten
+        UserData.objects.filter(user=self.user).update(transfer_envelope=self.envelope)
+        self.client.get(reverse("toggle-theme"))
+        self.assertEqual(
+            UserData.objects.get(user=self.user).transfer_envelope, self.envelope
+        )
+
+    def test_user_data_cached(self):
+        self.client.get(reverse("upload"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("upload"))
+        self.assertFalse(
+            [q for q in queries if "unclebudget_userdata" in q["sql"]],
+        )
+
+        self.envelope2.delete()
+        user_data = cache.get_user_data(self.user)
+        user_data.small_change_envelope = self.envelope
+        user_data.save()
+        self.assertEqual(
+            cache.get_user_data(self.user).small_change_envelope, self.envelope
+        )
+
     def test_no_anonymous_settings(self):
         with self.assertRaises(UserData.DoesNotExist):
             UserData.objects.for_user(AnonymousUser)
@@ -319,24 +612,29 @@ class ModelsTestCase(TestCase):
         # The new item's amount should be the remainder of the entry, balancing it
         self.assertTrue(entry.balanced)
 
-    def test_unbalanced_entries_cache(self):
-        unbalanced = cache.get_unbalanced_entries(self.user)
+    def test_unbalanced_entries(self):
+        unbalanced = Entry.objects.unbalanced_for(self.user)
         self.assertEqual(len(unbalanced), 0)
 
         item = Item.objects.first()
         item.amount += 1
         item.save()
 
-        unbalanced = cache.get_unbalanced_entries(self.user)
+        unbalanced = Entry.objects.unbalanced_for(self.user)
         self.assertEqual(len(unbalanced), 1)
         self.assertTrue(item.entry in unbalanced)
 
         item.amount -= 1
         item.save()
 
-        unbalanced = cache.get_unbalanced_entries(self.user)
+        unbalanced = Entry.objects.unbalanced_for(self.user)
         self.assertEqual(len(unbalanced), 0)
 
+        item.delete()
+
+        unbalanced = Entry.objects.unbalanced_for(self.user)
+        self.assertEqual(list(unbalanced), [item.entry])
+
     def test_balance_caches(self):
         account = Account.objects.first()
         entry = account.entry_set.first()
@@ -352,14 +650,84 @@ class ModelsTestCase(TestCase):
         self.assertEqual(account.balance, cache.get_account_balance(account))
         self.assertEqual(envelope.balance, cache.get_envelope_balance(envelope))
 
-    def test_item_date_cache(self):
+    def test_batch_balance_caches(self):
+        envelopes = [self.envelope, self.envelope2]
+        self.assertEqual(
+            cache.get_envelope_balances(envelopes),
+            {self.envelope.pk: self.envelope.balance, self.envelope2.pk: 0},
+        )
+        self.assertEqual(
+            cache.get_account_balances([self.account]),
+            {self.account.pk: self.account.balance},
+        )
+
+        with self.assertNumQueries(0):
+            cache.get_envelope_balances(envelopes)
+
+        item = self.envelope.item_set.first()
+        item.amount += 1
+        item.save()
+        self.assertEqual(
+            cache.get_envelope_balances(envelopes)[self.envelope.pk],
+            self.envelope.balance,
+        )
+
+    def test_item_date(self):
         item = Item.objects.first()
-        self.assertEqual(cache.get_item_date(item), item.entry.date)
+        self.assertEqual(item.date, item.entry.date)
 
-        item.entry.date = datetime.now()
+        item.entry.date = datetime.now().date()
         item.entry.save()
 
-        self.assertEqual(cache.get_item_date(item), item.entry.date)
+        item.refresh_from_db()
+        self.assertEqual(item.date, item.entry.date)
+
+        # The item moved to the new month's totals
+        month = EnvelopeMonth.objects.get(
+            envelope=item.envelope, month=item.date.replace(day=1)
+        )
+        self.assertEqual(month.expense_cents, ledger.to_cents(item.amount))
+        self.assertEqual(month.expense_count, 1)
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_indexes(self):
+        start, end = datetime(2021, 1, 1).date(), datetime(2021, 2, 1).date()
+        for queryset, index in (
+            (
+                Entry.objects.filter(
+                    account=self.account, date__gte=start, date__lte=end
+                ).values_list("date", "description", "amount"),
+                "entry_account_date_idx",
+            ),
+            (
+                Entry.objects.filter(account=self.account).order_by(
+                    "-date", "-amount", "-pk"
+                ),
+                "entry_account_date_idx",
+            ),
+            (
+                Entry.objects.filter(account=self.account, expected=True),
+                "entry_expected_idx",
+            ),
+            (
+                Entry.objects.filter(user=self.user).order_by("-date"),
+                "entry_user_date_idx",
+            ),
+            (
+                self.envelope.item_set.order_by("-date", "-amount", "-pk"),
+                "item_envelope_date_idx",
+            ),
+            (
+                EnvelopeMonth.objects.filter(
+                    user=self.user, month__gte=start, expense_count__gt=0
+                ).values("envelope", "month", "expense_cents"),
+                "envelopemonth_user_idx",
+            ),
+        ):
+            plan = queryset.explain()
+            self.assertIn(index, plan)
+            # The index gives the ordering, so there's no sort step
+            self.assertNotIn("TEMP B-TREE", plan)
 
     def test_skip_entry(self):
         # Unbalance the first two entries
@@ -485,6 +853,55 @@ class ModelsTestCase(TestCase):
         # item should have been created
         self.assertEqual(Item.objects.count(), prior_item_count + 1)
 
+    def test_envelope_distribute(self):
+        entry = Entry.objects.create(
+            amount=-200,
+            date=datetime.now().date(),
+            account=self.account,
+            user=self.user,
+        )
+        Item.objects.create(
+            amount=-200,
+            description="",
+            entry=entry,
+            envelope=self.envelope,
+            user=self.user,
+        )
+        envelope3 = Envelope.objects.create(name="Test Envelope 3", user=self.user)
+        prior_balance = self.envelope.balance
+        prior_item_count = Item.objects.count()
+
+        self.envelope.transfer_income(
+            {self.envelope2: 250, envelope3: Decimal("100.50")}
+        )
+
+        self.assertEqual(self.envelope.balance, prior_balance - Decimal("350.50"))
+        self.assertEqual(self.envelope2.balance, 250)
+        self.assertEqual(envelope3.balance, Decimal("100.50"))
+        # The newest item moves whole, and the paycheck is split twice
+        self.assertEqual(entry.item_set.get().envelope, self.envelope2)
+        self.assertEqual(Item.objects.count(), prior_item_count + 2)
+        self.assertFalse(Entry.objects.filter(unbalanced=True).exists())
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_envelope_transfer_atomic(self):
+        prior_balance = self.envelope.balance
+
+        with self.assertRaises(InsufficientFundsError):
+            self.envelope.transfer_income_to(self.envelope2, 1001)
+
+        # A failure partway through leaves everything where it was
+        with patch.object(Item.objects, "bulk_create", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.envelope.transfer_income_to(self.envelope2, 300)
+
+        self.assertEqual(self.envelope.balance, prior_balance)
+        self.assertEqual(self.envelope2.balance, 0)
+        self.assertFalse(self.envelope2.item_set.exists())
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
     def test_envelope_transfer_form(self):
         prior_balance = self.envelope.balance
         prior_item_count = Item.objects.count()
@@ -502,6 +919,28 @@ class ModelsTestCase(TestCase):
         self.assertEqual(self.envelope2.balance, 10)
         self.assertEqual(Item.objects.count(), prior_item_count + 1)
 
+    def test_envelope_transfer_invalid(self):
+        prior_balance = self.envelope.balance
+
+        with self.assertRaises(ValueError):
+            self.envelope.transfer_income({self.envelope2: -50})
+
+        for to_ids, amounts in [
+            ([self.envelope2.id, self.envelope2.id], ["100", "-50"]),
+            ([self.envelope2.id], ["ten"]),
+            ([self.envelope2.id], ["NaN"]),
+            (["two"], ["10"]),
+            ([self.envelope2.id], ["1001"]),
+        ]:
+            response = self.client.post(
+                reverse("envelope-transfer"),
+                {"from_id": self.envelope.id, "to_id": to_ids, "amount": amounts},
+            )
+            self.assertEqual(response.status_code, 400, amounts)
+
+        self.assertEqual(self.envelope.balance, prior_balance)
+        self.assertFalse(self.envelope2.item_set.exists())
+
     def test_template(self):
         Entry.objects.all().delete()
         Item.objects.all().delete()
@@ -568,9 +1007,559 @@ class ModelsTestCase(TestCase):
         self.assertEqual(self.envelope.balance, 15)
         self.assertEqual(self.envelope2.balance, 7)
 
+    def test_template_many_entries(self):
+        Item.objects.all().delete()
+
+        t = Template.objects.create(user=self.user)
+        TemplateItem.objects.create(template=t, envelope=self.envelope, amount=30)
+
+        entries = list(Entry.objects.filter(description__in=["PAYFRIEND", "PAYCHECK"]))
+        preview = t.build_items(entries)
+        self.assertEqual(len(preview), 2)
+        self.assertTrue(all(item.pk is None for item in preview))
+        self.assertEqual(Item.objects.count(), 0)
+
+        self.client.post(
+            reverse("apply-template"),
+            {
+                "entry_id": [entry.id for entry in entries],
+                "template_id": t.id,
+            },
+        )
+
+        # Signs follow each entry: 30 spent, 30 of the paycheck saved
+        self.assertEqual(Item.objects.count(), 2)
+        self.assertEqual(self.envelope.balance, 0)
+        self.assertEqual(
+            set(Item.objects.values_list("entry__description", "amount")),
+            {("PAYFRIEND", Decimal(30)), ("PAYCHECK", Decimal(-30))},
+        )
+        self.assertFalse(Entry.objects.get(description="PAYFRIEND").unbalanced)
+        self.assertTrue(Entry.objects.get(description="PAYCHECK").unbalanced)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_balances_follow_deletes(self):
+        entry = Entry.objects.get(description="PAYFRIEND")
+        entry.delete()
+
+        self.assertEqual(self.account.balance, Decimal("932.92"))
+        self.assertEqual(self.envelope.balance, Decimal("932.92"))
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_cascade_deletes(self):
+        # A cascade's ledger updates are batched, so its queries don't grow
+        # with the number of items
+        entry = Entry.objects.get(description="PAYCHECK")
+        query_counts = []
+        for count in (1, 8):
+            envelope = Envelope.objects.create(name=f"{count} items", user=self.user)
+            for _ in range(count):
+                Item.objects.create(
+                    amount=-1,
+                    description="",
+                    entry=entry,
+                    envelope=envelope,
+                    user=self.user,
+                )
+            with CaptureQueriesContext(connection) as queries:
+                envelope.delete()
+            query_counts.append(len(queries))
+
+            # The items' entry is balanced again without them
+            entry.refresh_from_db()
+            self.assertFalse(entry.unbalanced)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        self.envelope.delete()
+        self.assertEqual(Entry.objects.filter(unbalanced=True).count(), 4)
+        self.account.delete()
+        self.assertFalse(Entry.objects.exists())
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_cascade_delete_rolled_back(self):
+        envelope_balance = self.envelope.balance
+
+        def fail(**kwargs):
+            raise RuntimeError
+
+        # A delete that fails partway leaves the ledger as it was
+        post_delete.connect(fail, sender=Item)
+        try:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.account.delete()
+        finally:
+            post_delete.disconnect(fail, sender=Item)
+
+        self.assertEqual(self.envelope.balance, envelope_balance)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+        # So trying again only takes its rows off once
+        self.account.delete()
+        self.assertEqual(self.envelope.balance, 0)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_load_delete(self):
+        other = Account.objects.create(
+            name="Other", user=self.user, start_date=datetime(1970, 1, 1).date()
+        )
+        csv = """"Date","Description","Amount"
+01/12/2021,"LUNCH",-12"""
+        load, (entry,) = load_entries(other, csv)
+        Item.objects.create(
+            amount=12,
+            description="",
+            entry=entry,
+            envelope=self.envelope2,
+            user=self.user,
+        )
+        self.assertEqual(cache.get_account_balance(other), -12)
+        self.assertEqual(cache.get_envelope_balance(self.envelope2), -12)
+        envelope_balance = cache.get_envelope_balance(self.envelope)
+
+        self.assertEqual(
+            load.delete(),
+            (3, {"unclebudget.Item": 1, "unclebudget.Entry": 1, "unclebudget.Load": 1}),
+        )
+
+        self.assertFalse(Load.objects.filter(pk=load.pk).exists())
+        self.assertEqual(cache.get_account_balance(other), 0)
+        self.assertEqual(cache.get_envelope_balance(self.envelope2), 0)
+        self.assertEqual(cache.get_envelope_balance(self.envelope), envelope_balance)
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+    def test_rebuild_balances(self):
+        AccountBalance.objects.update(cents=0)
+        EnvelopeBalance.objects.all().delete()
+
+        with self.assertRaises(CommandError):
+            call_command("rebuildbalances", "--check", stdout=StringIO())
+
+        call_command("rebuildbalances", stdout=StringIO())
+        call_command("rebuildbalances", "--check", stdout=StringIO())
+
+        self.assertEqual(self.account.balance, Decimal("902.92"))
+        self.assertEqual(self.envelope.balance, Decimal("902.92"))
+
+    def test_rebuild_months(self):
+        EnvelopeMonth.objects.update(expense_cents=0)
+        EnvelopeMonth.objects.filter(income_count__gt=0).delete()
+
+        with self.assertRaises(CommandError):
+            call_command("rebuildmonths", "--check", stdout=StringIO())
+
+        call_command("rebuildmonths", stdout=StringIO())
+        call_command("rebuildmonths", "--check", stdout=StringIO())
+
+        month = EnvelopeMonth.objects.get(envelope=self.envelope)
+        self.assertEqual(month.month, date(2021, 1, 1))
+        self.assertEqual((month.income_cents, month.income_count), (-100000, 1))
+        self.assertEqual((month.expense_cents, month.expense_count), (9708, 3))
+
+    def test_monthly_expenses(self):
+        january = stats.date_to_cmonth(date(2021, 1, 1))
+        self.assertEqual(stats.cmonth_to_date(january), date(2021, 1, 1))
+        self.assertEqual(stats.cmonth_to_date(january - 1), date(2020, 12, 1))
+
+        monthly = stats.envelope_monthly_expenses(self.user)
+        self.assertEqual(monthly[self.envelope][january], Decimal("97.08"))
+        self.assertEqual(monthly[self.envelope][january + 1], 0)
+        self.assertEqual(sum(monthly[self.envelope2].values()), 0)
+
+        envelope_stats = stats.stats(self.user)[self.envelope]
+        self.assertEqual(envelope_stats[3], 0)
+        self.assertGreater(envelope_stats[0], 0)
+
+    def test_rolling_expenses(self):
+        monthly = array("q", [100, 200, 0, 300])
+        self.assertEqual(list(stats.rolling_expenses(monthly, 2)), [100, 300, 200, 300])
+        self.assertEqual(stats.mean_expenses(array("q", [0, 0, 100, 200])), 150)
+
+    def test_report_expenses_by_month(self):
+        user_data = UserData.objects.for_user(self.user)
+        user_data.transfer_envelope = self.envelope2
+        user_data.save()
+        Item.objects.create(
+            user=self.user,
+            amount=5,
+            description="",
+            entry=Entry.objects.get(description="PAYFRIEND"),
+            envelope=self.envelope2,
+        )
+
+        response = self.client.get(reverse("report-expenses-by-month"))
+        self.assertEqual(len(response.context["month_labels"]), 14)
+        self.assertEqual(response.context["envelopes"], {})
+
+        response = self.client.get(reverse("report-expenses-by-month"), {"months": 120})
+        envelopes = response.context["envelopes"]
+        self.assertEqual(list(envelopes), [self.envelope])
+        self.assertEqual(envelopes[self.envelope][(2021, 1)], Decimal("97.08"))
+        self.assertEqual(envelopes[self.envelope][(2021, 2)], 0)
+
+        response = self.client.get(
+            reverse("report-expenses-by-month"), {"months": 30000}
+        )
+        self.assertEqual(len(response.context["month_labels"]), 600)
+
+    def test_report_income(self):
+        Entry.objects.create(
+            account=self.account,
+            amount=-50,
+            date=date(2020, 6, 1),
+            description="OLD PAYCHECK",
+            user=self.user,
+        )
+        transfer = Entry.objects.create(
+            account=self.account,
+            amount=-200,
+            date=date(2021, 1, 5),
+            description="TRANSFER",
+            user=self.user,
+        )
+        Item.objects.create(
+            user=self.user,
+            amount=-200,
+            description="",
+            entry=transfer,
+            envelope=self.envelope2,
+        )
+        user_data = UserData.objects.for_user(self.user)
+        user_data.transfer_envelope = self.envelope2
+        user_data.save()
+
+        response = self.client.get(reverse("report-income"))
+        self.assertEqual(response.context["all_years"], [2021, 2020])
+        self.assertEqual(
+            [entry.description for entry in response.context["years"][2021][1]],
+            ["PAYCHECK"],
+        )
+
+        response = self.client.get(reverse("report-income"), {"year": 2020})
+        self.assertEqual(list(response.context["years"]), [2020])
+
+    def test_account_detail_pages(self):
+        url = reverse("account-detail", kwargs={"pk": self.account.id})
+        response = self.client.get(url)
+        all_entries = [
+            (entry.pk, entry.ongoing_balance) for entry in response.context["entries"]
+        ]
+        self.assertIsNone(response.context["older"])
+
+        entries = []
+        after = None
+        with patch("unclebudget.pagination.PAGE_SIZE", 3):
+            while True:
+                response = self.client.get(url, {"after": after} if after else {})
+                entries += [
+                    (entry.pk, entry.ongoing_balance)
+                    for entry in response.context["entries"]
+                ]
+                after = response.context["older"]
+                if not after:
+                    break
+
+        self.assertEqual(entries, all_entries)
+        self.assertEqual(len(entries), 4)
+
+        response = self.client.get(url, {"after": "bad"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_account_detail_pages_after_change(self):
+        url = reverse("account-detail", kwargs={"pk": self.account.id})
+        with patch("unclebudget.pagination.PAGE_SIZE", 3):
+            response = self.client.get(url)
+            after = response.context["older"]
+
+            # An entry on the next page changes before it loads
+            entry = Entry.objects.exclude(
+                pk__in=[entry.pk for entry in response.context["entries"]]
+            ).get()
+            entry.amount -= 100
+            entry.save()
+
+            response = self.client.get(url, {"after": after})
+            entries = [
+                (entry.pk, entry.ongoing_balance)
+                for entry in response.context["entries"]
+            ]
+
+        response = self.client.get(url)
+        all_entries = [
+            (entry.pk, entry.ongoing_balance) for entry in response.context["entries"]
+        ]
+        self.assertEqual(entries, all_entries[3:])
+
+    def test_envelope_detail_pages(self):
+        url = reverse("envelope-detail", kwargs={"pk": self.envelope.id})
+        with patch("unclebudget.pagination.PAGE_SIZE", 3):
+            response = self.client.get(url)
+            self.assertEqual(len(response.context["items"]), 3)
+
+            response = self.client.get(url, {"after": response.context["older"]})
+            self.assertEqual(len(response.context["items"]), 1)
+            self.assertIsNone(response.context["older"])
+
+
+class SyntheticTestCase(TestCase):
+    databases = {"default", "cache"}
+
+    def setUp(self):
+        caches["default"].clear()
+
+    def test_generate_deterministic(self):
+        first, second = (
+            synthetic.generate(entries=300, seed=1, prefix=prefix)[0]
+            for prefix in ("a", "b")
+        )
+        self.assertEqual(ledger.rebuild(fix=False), [])
+        self.assertEqual(ledger.rebuild_months(fix=False), [])
+
+        def rows(user):
+            return list(
+                Entry.objects.filter(user=user)
+                .order_by("pk")
+                .values_list("date", "amount", "description", "expected", "unbalanced")
+            )
+
+        self.assertEqual(len(rows(first)), 300)
+        self.assertEqual(rows(first), rows(second))
+
+        entries = Entry.objects.filter(user=first)
+        self.assertTrue(entries.filter(expected=True).exists())
+        self.assertTrue(entries.filter(unbalanced=True).exists())
+        self.assertFalse(entries.filter(unbalanced=False, item__isnull=True).exists())
+        self.assertTrue(
+            entries.annotate(items=Count("item")).filter(items__gt=1).exists()
+        )
+
+    def test_benchmark(self):
+        (user,) = synthetic.generate(entries=200)
+        results = benchmark.run(user, repeat=1)
+        self.assertEqual(
+            [result["name"] for result in results],
+            [name for name, _ in benchmark.targets(user)],
+        )
+        # Loading is rolled back
+        self.assertFalse(Load.objects.exclude(loader="synthetic").exists())
+
+
+class QueryBudgetTestCase(TestCase):
+    """Every URL stays within its query and cache budget, whatever the size of
+    the ledger"""
+
+    databases = {"default", "cache"}
+
+    # URL name: (ledger database queries, cache calls), counted with a cold
+    # cache. Sessions and the user cost most pages 2 queries and 2 cache calls.
+    BUDGETS = {
+        "summary": (9, 4),
+        "account-detail": (9, 4),
+        "all": (9, 6),
+        "apply-template": (15, 2),
+        "entry-detail": (12, 3),
+        "entry-skip": (3, 2),
+        "envelope-detail": (8, 4),
+        "envelope_month": (5, 2),
+        "envelope-create": (3, 2),
+        "envelope-transfer": (5, 4),
+        "expect": (5, 2),
+        "login": (3, 2),
+        "metrics": (2, 0),
+        "process": (3, 1),
+        "report-expenses-by-month": (6, 2),
+        "report-income": (6, 2),
+        "toggle-theme": (5, 3),
+        "upload": (5, 2),
+        "import-job": (8, 2),
+        "import-job-progress": (3, 0),
+    }
+
+    # Two months of entries, so a month of an envelope has several items
+    SIZES = {
+        "small": {"accounts": 2, "envelopes": 6, "entries": 20, "days": 60},
+        "large": {"accounts": 5, "envelopes": 20, "entries": 300, "days": 60},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {}
+        for prefix, size in cls.SIZES.items():
+            (user,) = synthetic.generate(prefix=prefix, **size)
+            user.is_staff = True
+            user.save()
+            ImportJob.objects.create(
+                account=Account.objects.filter(user=user).first(),
+                csv="",
+                load=Load.objects.filter(user=user).first(),
+                status=ImportJob.Status.DONE,
+                user=user,
+            )
+            cls.users[prefix] = user
+
+    def request(self, name, user):
+        """Method, URL and data to request the URL called name as user"""
+        envelope = Envelope.objects.filter(user=user).exclude(name="Income").first()
+        item = envelope.item_set.first()
+        # An entry split across envelopes, with unbalanced ones to process
+        entry = (
+            Entry.objects.filter(user=user)
+            .annotate(items=Count("item"))
+            .filter(items__gt=1)
+            .first()
+        )
+        kwargs = {
+            "account-detail": {"pk": Account.objects.filter(user=user).first().pk},
+            "entry-detail": {"pk": entry.pk},
+            "entry-skip": {"pk": entry.pk},
+            "envelope-detail": {"pk": envelope.pk},
+            "envelope_month": {
+                "pk": envelope.pk,
+                "year": item.date.year,
+                "month": item.date.month,
+            },
+            "import-job": {"pk": ImportJob.objects.get(user=user).pk},
+            "import-job-progress": {"pk": ImportJob.objects.get(user=user).pk},
+        }
+        url = reverse(name, kwargs=kwargs.get(name))
+
+        if name == "apply-template":
+            return (
+                "post",
+                url,
+                {
+                    "template_id": Template.objects.get(user=user).pk,
+                    "entry_id": Entry.objects.unbalanced_for(user).first().pk,
+                },
+            )
+        return "get", url, {}
+
+    def count(self, name, user):
+        """Queries and cache calls made requesting the URL called name"""
+        method, url, data = self.request(name, user)
+        caches["default"].clear()
+
+        calls = []
+
+        def counted(method):
+            original = getattr(LayeredCache, method)
+
+            def wrapper(*args, **kwargs):
+                calls.append(method)
+                return original(*args, **kwargs)
+
+            return wrapper
+
+        with ExitStack() as stack:
+            for cache_method in ("get", "get_many", "set", "set_many", "delete"):
+                stack.enter_context(
+                    patch.object(LayeredCache, cache_method, counted(cache_method))
+                )
+            queries = stack.enter_context(CaptureQueriesContext(connection))
+            response = getattr(self.client, method)(url, data)
+
+        self.assertLess(response.status_code, 400, url)
+        return len(queries), len(calls)
+
+    def test_budgets(self):
+        from .urls import urlpatterns
+
+        for pattern in urlpatterns:
+            with self.subTest(pattern.name):
+                self.assertIn(pattern.name, self.BUDGETS, "New URLs need a budget")
+                queries, calls = self.BUDGETS[pattern.name]
+
+                counts = {}
+                for size, user in self.users.items():
+                    self.client.force_login(user)
+                    counts[size] = self.count(pattern.name, user)
+                    self.assertLessEqual(counts[size][0], queries, f"{size} queries")
+                    self.assertLessEqual(counts[size][1], calls, f"{size} cache calls")
+
+                # Anything per row, envelope or account is an N+1
+                self.assertEqual(counts["small"], counts["large"], "Counts grow")
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "layered_test": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "layered_test",
+        },
+    }
+)
+class LayeredCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = LayeredCache(
+            "layered_test",
+            {
+                "OPTIONS": {
+                    "MAX_ENTRIES": 2,
+                    "FAMILIES": {"item:date": {"MAX_ENTRIES": 1}},
+                }
+            },
+        )
+        self.cache.clear()
+        self.cache.local_hits.clear()
+        self.cache.shared_hits.clear()
+        self.cache.misses.clear()
+
+    def test_families_evicted_separately(self):
+        self.cache.set("account:1:balance", 1)
+        self.cache.set("item:1:date", 1)
+        self.cache.set("item:2:date", 2)
+
+        self.assertEqual(self.cache.get("account:1:balance"), 1)
+        self.assertEqual(self.cache.get("item:1:date"), 1)
+        self.assertEqual(self.cache.get("item:3:date"), None)
+        self.assertEqual(
+            self.cache.stats(),
+            {
+                "account:balance": {"local_hits": 1, "shared_hits": 0, "misses": 0},
+                # item 1 was pushed out of the local layer by item 2
+                "item:date": {"local_hits": 0, "shared_hits": 1, "misses": 1},
+            },
+        )
+
+    def test_get_many(self):
+        self.cache.set_many({"account:1:balance": 1, "account:2:balance": 2})
+        caches["layered_test"].set("envelope:1:balance", 3)
+
+        self.assertEqual(
+            self.cache.get_many(
+                ["account:1:balance", "envelope:1:balance", "envelope:2:balance"]
+            ),
+            {"account:1:balance": 1, "envelope:1:balance": 3},
+        )
+
+        self.cache.delete("account:1:balance")
+        self.assertFalse(self.cache.has_key("account:1:balance"))
+        self.assertEqual(caches["layered_test"].get("account:1:balance"), None)
+
+    def test_local_timeout(self):
+        self.cache.set("account:1:balance", 1)
+
+        # Another process changes the balance, which this process only sees
+        # once its local copy times out
+        caches["layered_test"].set("account:1:balance", 2)
+        self.assertEqual(self.cache.get("account:1:balance"), 1)
+        with patch("unclebudget.cache_backends.time", return_value=time() + 5):
+            self.assertEqual(self.cache.get("account:1:balance"), 2)
+
 
 class LoginTestCase(TestCase):
+    databases = {"default", "cache"}
+
     def setUp(self):
+        # The local cache layer isn't rolled back between tests
+        caches["default"].clear()
+
         User.objects.create_user("testuser", "testuser@example.com", "password").save()
         self.user = User.objects.get()
 
@@ -20,6 +20,7 @@ urlpatterns = [
     path("envelope/transfer", envelope_transfer, name="envelope-transfer"),
     path("expect", expect, name="expect"),
     path("login", LoginView.as_view(), name="login"),
+    path("metrics", metrics, name="metrics"),
     path("process", process, name="process"),
     path(
         "report/expenses-by-month",
@@ -29,4 +30,6 @@ urlpatterns = [
     path("report/income", report_income, name="report-income"),
     path("toggle-theme", toggle_theme, name="toggle-theme"),
     path("upload", upload, name="upload"),
+    path("upload/<int:pk>", import_job, name="import-job"),
+    path("upload/<int:pk>/progress", import_job_progress, name="import-job-progress"),
 ]
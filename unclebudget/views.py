@@ -1,43 +1,99 @@
+import asyncio
 from collections import OrderedDict
 from datetime import date, datetime
-from decimal import Decimal
-from operator import attrgetter
+from decimal import Decimal, InvalidOperation
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView as auth_LoginView
-from django.db.models import Q
-from django.http import Http404, HttpResponseRedirect
-from django.shortcuts import get_object_or_404, redirect, render, reverse
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+)
+from django.shortcuts import (
+    get_list_or_404,
+    get_object_or_404,
+    redirect,
+    render,
+    reverse,
+)
+from django.utils.crypto import constant_time_compare
 from django.views.generic import CreateView
 
-from . import cache, stats
+from . import cache, imports, ledger, pagination, stats
+from .exceptions import InsufficientFundsError
 from .forms import EnvelopeForm
+from .metrics import registry
 from .models import *
-from .loader import load_entries
+
+# Most months the expenses by month report will show
+REPORT_MAX_MONTHS = 12 * 50
+
+
+def with_balances(objects, get_balances):
+    """Set cached_balance on each of objects, for balance tables"""
+    objects = list(objects)
+    balances = get_balances(objects)
+    for obj in objects:
+        obj.cached_balance = balances[obj.pk]
+    return objects
+
+
+# The read-heavy pages are async views, so an ASGI server can serve many of
+# them from one process. Their independent queries are gathered, and anything
+# without an async API (the cache helpers, rendering templates that may
+# query) runs through sync_to_async.
+awith_balances = sync_to_async(with_balances)
+arender = sync_to_async(render)
+
+
+async def alist(queryset):
+    return [obj async for obj in queryset]
 
 
 @login_required
-def account_detail(request, pk):
-    accounts = Account.objects.filter(user=request.user)
+async def account_detail(request, pk):
+    user = await request.auser()
+    accounts = Account.objects.filter(user=user)
     try:
-        account = accounts.get(pk=pk)
+        account = await accounts.aget(pk=pk)
     except Account.DoesNotExist:
         raise Http404()
 
-    entries = account.entry_set.all()
-
-    accounts_balance = sum([cache.get_account_balance(account) for account in accounts])
-
-    ongoing_balance = cache.get_account_balance(account)
+    (entries, more, state), accounts, templates = await asyncio.gather(
+        pagination.akeyset_page(account.entry_set.all(), request.GET.get("after")),
+        awith_balances(accounts, cache.get_account_balances),
+        alist(Template.objects.filter(user=user)),
+    )
+    accounts_balance = sum([account.cached_balance for account in accounts])
+    # The balance table already looked up this account's balance
+    account = next(a for a in accounts if a.pk == account.pk)
+
+    # Later pages carry on from the balance before the entries on earlier
+    # pages, as they are now
+    ongoing_balance = account.cached_balance
+    if state:
+        newer = await pagination.rows_before(account.entry_set.all(), state).aaggregate(
+            cents=Sum(ledger.cents("amount"))
+        )
+        ongoing_balance += ledger.from_cents(newer["cents"] or 0)
     for entry in entries:
         entry.ongoing_balance = ongoing_balance
         ongoing_balance += entry.amount
 
-    return render(
+    older = None
+    if more:
+        older = pagination.cursor_after(entries[-1].date, entries[-1])
+
+    return await arender(
         request,
         "unclebudget/account_detail.html",
         {
@@ -45,25 +101,27 @@ def account_detail(request, pk):
             "accounts": accounts,
             "accounts_balance": accounts_balance,
             "entries": entries,
+            "older": older,
+            "templates": templates,
         },
     )
 
 
 @login_required
-def all(request):
-    accounts = Account.objects.filter(user=request.user)
-    envelopes = Envelope.objects.filter(user=request.user)
+async def all(request):
+    user = await request.auser()
+    accounts, envelopes, to_process = await asyncio.gather(
+        awith_balances(Account.objects.filter(user=user), cache.get_account_balances),
+        awith_balances(Envelope.objects.filter(user=user), cache.get_envelope_balances),
+        Entry.objects.unbalanced_for(user).acount(),
+    )
 
     # TODO we should probably cache this somewhere
     # (but we also want to make sure it's actually useful data)
-    accounts_balance = sum([cache.get_account_balance(account) for account in accounts])
-    envelopes_balance = sum(
-        [cache.get_envelope_balance(envelope) for envelope in envelopes]
-    )
+    accounts_balance = sum([account.cached_balance for account in accounts])
+    envelopes_balance = sum([envelope.cached_balance for envelope in envelopes])
 
-    to_process = cache.get_unbalanced_entries(request.user)
-
-    return render(
+    return await arender(
         request,
         "unclebudget/all.html",
         {
@@ -79,8 +137,10 @@ def all(request):
 @login_required
 def apply_template(request):
     template = Template.objects.get(user=request.user, pk=request.POST["template_id"])
-    entry = Entry.objects.get(user=request.user, pk=request.POST["entry_id"])
-    template.apply_to(entry)
+    entries = get_list_or_404(
+        Entry, user=request.user, pk__in=request.POST.getlist("entry_id")
+    )
+    template.apply_to(*entries)
     return redirect(reverse("process"))
 
 
@@ -137,9 +197,9 @@ def entry_detail(request, pk):
             Item.objects.get(pk=item_id).delete()
 
         for item_id in to_split_item_ids:
-            Item.objects.filter(pk=item_id).update(
-                amount=to_split_amount / len(to_split_item_ids)
-            )
+            item = Item.objects.get(pk=item_id)
+            item.amount = to_split_amount / len(to_split_item_ids)
+            item.save()
 
         # Save entry to update cache
         entry.save()
@@ -149,8 +209,10 @@ def entry_detail(request, pk):
 
     envelopes = Envelope.objects.filter(user=request.user)
 
-    to_process = list(cache.get_unbalanced_entries(request.user))
-    to_process.sort(key=attrgetter("date"))
+    # Each open entry shows its balance, which needs its items
+    to_process = list(
+        Entry.objects.unbalanced_for(request.user).prefetch_related("item_set")
+    )
     skipped = cache.get_skipped_entries(user=request.user)
     if to_process:
         while to_process[0] in skipped:
@@ -178,24 +240,35 @@ def entry_skip(request, pk):
 
 
 @login_required
-def envelope_detail(request, pk):
-    envelopes = Envelope.objects.filter(user=request.user)
+async def envelope_detail(request, pk):
+    envelopes = Envelope.objects.filter(user=await request.auser())
     try:
-        envelope = envelopes.get(pk=pk)
+        envelope = await envelopes.aget(pk=pk)
     except Envelope.DoesNotExist:
         raise Http404()
 
-    envelopes_balance = sum(
-        [cache.get_envelope_balance(envelope) for envelope in envelopes]
+    (items, more, _), envelopes = await asyncio.gather(
+        pagination.akeyset_page(
+            envelope.item_set.select_related("entry"),
+            request.GET.get("after"),
+        ),
+        awith_balances(envelopes, cache.get_envelope_balances),
     )
+    envelopes_balance = sum([envelope.cached_balance for envelope in envelopes])
 
-    return render(
+    older = None
+    if more:
+        older = pagination.cursor_after(items[-1].date, items[-1])
+
+    return await arender(
         request,
         "unclebudget/envelope_detail.html",
         {
             "envelope": envelope,
             "envelopes": envelopes,
             "envelopes_balance": envelopes_balance,
+            "items": items,
+            "older": older,
         },
     )
 
@@ -203,7 +276,11 @@ def envelope_detail(request, pk):
 @login_required
 def envelope_month(request, pk, year, month):
     envelope = Envelope.objects.get(pk=pk)
-    items = envelope.item_set.filter(entry__date__year=year, entry__date__month=month)
+    items = envelope.item_set.select_related("entry")
+    # A date range can use the item indexes, unlike __year and __month
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    items = items.filter(date__gte=start, date__lt=end)
     return render(
         request,
         "unclebudget/envelope_item_subset.html",
@@ -221,14 +298,32 @@ def envelope_transfer(request):
         from_envelope = Envelope.objects.get(
             user=request.user, pk=request.POST["from_id"]
         )
-        to_envelope = Envelope.objects.get(user=request.user, pk=request.POST["to_id"])
-        amount = Decimal(request.POST["amount"])
+        try:
+            # Several to_id and amount pairs distribute across envelopes at once
+            to_envelopes = Envelope.objects.filter(user=request.user).in_bulk(
+                request.POST.getlist("to_id")
+            )
+            amounts = {}
+            for to_id, amount in zip(
+                request.POST.getlist("to_id"), request.POST.getlist("amount")
+            ):
+                to_envelope = to_envelopes.get(int(to_id))
+                if not to_envelope:
+                    raise Http404()
+                amount = Decimal(amount)
+                if not amount.is_finite() or amount < 0:
+                    raise ValueError(f"Invalid amount {amount}")
+                amounts[to_envelope] = amounts.get(to_envelope, 0) + amount
 
-        from_envelope.transfer_income_to(to_envelope, amount)
+            from_envelope.transfer_income(amounts)
+        except (ValueError, InvalidOperation, InsufficientFundsError) as e:
+            return HttpResponseBadRequest(str(e))
 
         return redirect("summary")
 
-    envelopes = Envelope.objects.filter(user=request.user)
+    envelopes = with_balances(
+        Envelope.objects.filter(user=request.user), cache.get_envelope_balances
+    )
 
     return render(
         request,
@@ -330,55 +425,90 @@ class LoginView(auth_LoginView):
         return super().dispatch(request, *args, **kwargs)
 
 
+def metrics(request):
+    # Staff can look in a browser; scrapers send UNCLEBUDGET_METRICS_TOKEN
+    token = settings.UNCLEBUDGET_METRICS_TOKEN
+    authorized = request.user.is_staff or (
+        token
+        and constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        )
+    )
+    if not authorized:
+        raise Http404()
+
+    return HttpResponse(
+        registry.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @login_required
 def process(request):
-    to_process = list(cache.get_unbalanced_entries(request.user))
-    to_process.sort(key=attrgetter("date"))
-
-    if not to_process:
-        return redirect("summary")
+    to_process = Entry.objects.unbalanced_for(request.user).only("pk")
 
     skipped = cache.get_skipped_entries(request.user)
-    for entry in to_process:
-        if entry in skipped:
-            continue
+    first = None
+    for entry in to_process.iterator():
+        if entry not in skipped:
+            return redirect("entry-detail", entry.pk)
+
+        if first is None:
+            first = entry
 
-        return redirect("entry-detail", entry.pk)
+    if first is None:
+        return redirect("summary")
 
     # If we've skipped every entry, act like nothing is skipped
     cache.clear_skipped_entries(request.user)
-    return redirect("entry-detail", to_process[0].pk)
+    return redirect("entry-detail", first.pk)
 
 
 @login_required
-def report_expenses_by_month(request):
+async def report_expenses_by_month(request):
+    try:
+        months = min(max(int(request.GET["months"]), 1), REPORT_MAX_MONTHS)
+    except (KeyError, ValueError):
+        months = settings.UNCLEBUDGET_REPORT_MONTHS
+
     now = datetime.now()
 
     now_monthno = 12 * now.year + (now.month - 1)
-    start_monthno = now_monthno - 13
+    start_monthno = now_monthno - (months - 1)
     monthno_range = range(now_monthno, start_monthno - 1, -1)
 
     start_date = date(year=start_monthno // 12, month=(start_monthno % 12) + 1, day=1)
 
-    envelopes = OrderedDict()
-    for item in Item.objects.filter(
-        user=request.user, amount__gt=0, entry__date__gte=start_date
-    ).order_by("-envelope__pinned", "envelope__name"):
-        if item.envelope == request.user.userdata.transfer_envelope:
-            continue
-
-        if item.envelope not in envelopes:
-            envelopes[item.envelope] = OrderedDict()
-            for n in monthno_range:
-                year = n // 12
-                month = (n % 12) + 1
-                envelopes[item.envelope][(year, month)] = Decimal()
-
-        envelopes[item.envelope][
-            (item.entry.date.year, item.entry.date.month)
-        ] += item.amount
+    user_data = await request.auser_data()
+    expenses = EnvelopeMonth.objects.filter(
+        user=user_data.user_id, expense_count__gt=0, month__gte=start_date
+    )
+    transfer_envelope_id = user_data.transfer_envelope_id
+    if transfer_envelope_id:
+        expenses = expenses.exclude(envelope_id=transfer_envelope_id)
 
-    return render(
+    totals = [
+        total
+        async for total in expenses.values("envelope_id", "month", "expense_cents")
+    ]
+
+    envelopes = OrderedDict()
+    async for envelope in Envelope.objects.filter(
+        pk__in=set(total["envelope_id"] for total in totals)
+    ).order_by("-pinned", "name"):
+        envelopes[envelope] = OrderedDict()
+        for n in monthno_range:
+            year = n // 12
+            month = (n % 12) + 1
+            envelopes[envelope][(year, month)] = Decimal()
+
+    envelopes_by_id = {envelope.pk: envelope for envelope in envelopes}
+    for total in totals:
+        envelopes[envelopes_by_id[total["envelope_id"]]][
+            (total["month"].year, total["month"].month)
+        ] = ledger.from_cents(total["expense_cents"])
+
+    return await arender(
         request,
         "unclebudget/report-expenses-by-month.html",
         {
@@ -386,22 +516,30 @@ def report_expenses_by_month(request):
             "month_labels": [
                 (monthno // 12, (monthno % 12) + 1) for monthno in monthno_range
             ],
+            "months": months,
         },
     )
 
 
 @login_required
-def report_income(request):
-    transfer_envelope = request.user.userdata.transfer_envelope
+async def report_income(request):
+    user_data = await request.auser_data()
+    entries = Entry.objects.filter(user=user_data.user_id, amount__lt=0)
+    transfer_envelope_id = user_data.transfer_envelope_id
+    if transfer_envelope_id:
+        entries = entries.exclude(item__envelope_id=transfer_envelope_id)
+
+    # Show one year at a time, most recent first
+    all_years = [d.year async for d in entries.dates("date", "year", order="DESC")]
+    try:
+        year = int(request.GET["year"])
+    except (KeyError, ValueError):
+        year = all_years[0] if all_years else datetime.now().year
 
     years = OrderedDict()
-    for entry in Entry.objects.filter(
-        user=request.user,
-        amount__lt=0,
-    ).order_by("-date"):
-        if entry.item_set.first().envelope == transfer_envelope:
-            continue
-
+    async for entry in (
+        entries.filter(date__year=year).select_related("account").order_by("-date")
+    ):
         if entry.date.year not in years:
             years[entry.date.year] = OrderedDict()
 
@@ -410,10 +548,12 @@ def report_income(request):
 
         years[entry.date.year][entry.date.month].append(entry)
 
-    return render(
+    return await arender(
         request,
         "unclebudget/report-income.html",
         {
+            "all_years": all_years,
+            "year": year,
             "years": years,
         },
     )
@@ -429,20 +569,20 @@ def report(request):
 
 
 @login_required
-def summary(request):
-    envelopes = Envelope.objects.filter(user=request.user)
-    pinned = envelopes.filter(user=request.user, pinned=True)
-    negative = [
-        envelope for envelope in envelopes if cache.get_envelope_balance(envelope) < 0
-    ]
-
-    to_process = cache.get_unbalanced_entries(request.user)
+async def summary(request):
+    user = await request.auser()
+    envelopes, to_process, latest_entry, latest_load = await asyncio.gather(
+        awith_balances(Envelope.objects.filter(user=user), cache.get_envelope_balances),
+        Entry.objects.unbalanced_for(user).acount(),
+        Entry.objects.filter(user=user).order_by("-date").afirst(),
+        Load.objects.filter(user=user).order_by("-timestamp").afirst(),
+    )
+    pinned = [envelope for envelope in envelopes if envelope.pinned]
+    negative = [envelope for envelope in envelopes if envelope.cached_balance < 0]
 
-    latest_entry = Entry.objects.filter(user=request.user).order_by("-date").first()
-    latest_load = Load.objects.filter(user=request.user).order_by("-timestamp").first()
     latest_date = max(latest_entry.date, latest_load.timestamp.date())
 
-    return render(
+    return await arender(
         request,
         "unclebudget/summary.html",
         {
@@ -456,29 +596,38 @@ def summary(request):
 
 @login_required
 def toggle_theme(request):
-    settings = UserData.objects.for_user(request.user)
-    settings.dark_mode = not settings.dark_mode
-    settings.save()
+    user_data = request.user_data
+    user_data.dark_mode = not user_data.dark_mode
+    # user_data may be a stale copy from the cache, so only write dark_mode
+    user_data.save(update_fields=["dark_mode"])
     return redirect(request.META.get("HTTP_REFERER", reverse("summary")))
 
 
 @login_required
-def upload(request):
-    entries = None
-    no_new_entries = False
-
+def upload(request, job=None):
     if request.method == "POST":
         account = get_object_or_404(
             Account, user=request.user, pk=request.POST["account"]
         )
-        text = request.FILES["csv"].read()
-        load, entries = load_entries(account, text)
-        if not entries:
+        job = imports.enqueue(account, request.FILES["csv"])
+        return redirect(job)
+
+    entries = None
+    no_new_entries = False
+    if job and job.status == ImportJob.Status.DONE:
+        if job.load:
+            entries = job.load.entry_set.select_related("account")
+        else:
             no_new_entries = True
-            load.delete()
 
     accounts = Account.objects.filter(user=request.user)
-    loads = Load.objects.filter(user=request.user)
+    # A load's entries all come from one account
+    loads = Load.objects.filter(user=request.user).annotate(
+        account_name=Subquery(
+            Entry.objects.filter(load=OuterRef("pk")).values("account__name")[:1]
+        ),
+        entry_count=Count("entry"),
+    )
 
     return render(
         request,
@@ -486,7 +635,35 @@ def upload(request):
         {
             "accounts": accounts,
             "loads": loads,
+            "job": job,
             "entries": entries,
             "no_new_entries": no_new_entries,
         },
     )
+
+
+@login_required
+def import_job(request, pk):
+    job = get_object_or_404(ImportJob, user=request.user, pk=pk)
+    return upload(request, job)
+
+
+@login_required
+def import_job_progress(request, pk):
+    job = get_object_or_404(ImportJob, user=request.user, pk=pk)
+    if imports.is_stale(job):
+        imports.recover()
+        job.refresh_from_db()
+
+    return JsonResponse(
+        {
+            "status": job.status,
+            "finished": job.finished,
+            "rows": job.rows,
+            "matched": job.matched,
+            "inserted": job.inserted,
+            "duplicates": job.duplicates,
+            "error": job.error,
+            "seconds": job.seconds,
+        }
+    )